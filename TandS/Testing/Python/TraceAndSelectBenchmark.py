@@ -0,0 +1,314 @@
+"""Benchmarks of the TraceAndSelect tracing and fill pipeline on synthetic CT phantoms.
+
+Runs in plain CPython with numpy: the pipeline lives in TraceAndSelectLib, which does
+not need Slicer. Every stage is run on every phantom and reported with its median
+latency, peak traced memory and a summary of its output, then compared against a
+stored baseline:
+
+    python TraceAndSelectBenchmark.py --quick
+    python TraceAndSelectBenchmark.py --quick --no-timing
+    python TraceAndSelectBenchmark.py --save-baseline
+
+Latencies are compared relative to a reference workload timed in the same run, so
+that a slower or busier machine does not read as a regression. Exits with status 1
+if a stage output changed, if a stage used more memory than the baseline by more than
+the memory tolerance, or, unless --no-timing is given, if a stage got slower by more
+than the tolerance.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tracemalloc
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from TraceAndSelectLib import core
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'TraceAndSelectBenchmarkBaseline.json')
+
+# Plane sizes and (size, slices) of the volumes used for propagation
+SIZES = (256, 512, 1024)
+VOLUMES = ((256, 500), (512, 100))
+QUICK_SIZES = (256,)
+QUICK_VOLUMES = ((256, 20),)
+
+# Thresholds of bone mode
+HI = 2799
+LO = 250
+MAX_PIXELS = 250000
+
+#
+# Phantoms
+#
+
+def disk_distance(n, slices, drift):
+  """Return the distance of every voxel to the axis of a cylinder drifting drift pixels per slice."""
+  yy, xx = numpy.mgrid[0:n, 0:n]
+  center = n // 2
+  return [numpy.hypot(yy - center - drift * s, xx - center) for s in range(slices)]
+
+def ring(n, slices=1, noise=0, seed=0):
+  """Cortical bone ring around a marrow cavity, optionally with gaussian noise."""
+  rng = numpy.random.RandomState(seed)
+  volume = numpy.zeros((slices, n, n), dtype=numpy.int16)
+  for s, d in enumerate(disk_distance(n, slices, 0.05)):
+    plane = numpy.where((d >= 0.16 * n) & (d <= 0.2 * n), 1000, 40)
+    if noise:
+      plane = plane + rng.normal(0, noise, plane.shape)
+    volume[s] = plane
+  return volume
+
+def nested(n, slices=1):
+  """Bone shell with a solid cylinder inside it, clicked in between."""
+  volume = numpy.zeros((slices, n, n), dtype=numpy.int16)
+  for s, d in enumerate(disk_distance(n, slices, 0.05)):
+    volume[s] = numpy.where((d >= 0.3 * n) & (d <= 0.34 * n), 1000, numpy.where(d <= 0.1 * n, 900, 40))
+  return volume
+
+def shell(n, slices=1):
+  """Noisy cortical bone shell of varying thickness."""
+  rng = numpy.random.RandomState(3)
+  yy, xx = numpy.mgrid[0:n, 0:n]
+  thickness = 0.04 * n * (1 + 0.5 * numpy.sin(3 * numpy.arctan2(yy - n // 2, xx - n // 2)))
+  volume = numpy.zeros((slices, n, n), dtype=numpy.int16)
+  for s, d in enumerate(disk_distance(n, slices, 0.05)):
+    plane = numpy.where((d >= 0.16 * n) & (d <= 0.16 * n + thickness), 1000, 40)
+    volume[s] = plane + rng.normal(0, 100, plane.shape)
+  return volume
+
+def leak(n, slices=1):
+  """Ring cracked by a one pixel diagonal line, that a 4-connected fill could get through.
+  The traced contour steps over the crack, and the fill has to stay inside it.
+  """
+  volume = ring(n, slices)
+  rows = numpy.arange(n // 2, n - n // 32)
+  volume[:, rows, rows + n // 32] = 40
+  return volume
+
+def click(phantom, n):
+  """Return the in-plane point clicked on a phantom of size n."""
+  if phantom is nested:
+    return (n // 2, int(0.2 * n))
+  return (n // 2, n // 2)
+
+PHANTOMS = (ring, nested, shell, leak)
+
+#
+# Stages
+#
+
+def path_output(path):
+  """Output of a stage returning a (points, visited, dead_ends) path."""
+  points, visited, dead_ends = path
+  return {'found': dead_ends >= 0, 'points': len(points), 'pixels': len(visited)}
+
+def paths_output(paths):
+  """Output of a stage tracing a list of paths."""
+  return {'paths': len(paths), 'closed': sum(1 for path in paths if core.path_closed(path[0])),
+          'points': sum(len(path[0]) for path in paths)}
+
+def plane_output(outcome):
+  """Output of segment_plane."""
+  result, error = outcome
+  return {'error': error, 'pixels': int(result[0].sum()) if result is not None else 0}
+
+def volume_output(outcome):
+  """Output of segment."""
+  labelArray, filled, error = outcome
+  return {'error': error, 'slices': filled, 'pixels': int(numpy.count_nonzero(labelArray))}
+
+def plane_stages(bgArray, point):
+  """Return the (name, function, output) stages run on one plane, each prepared from the stages
+  before it. output summarizes the result of function for comparison with the baseline.
+  """
+  labelArray = numpy.zeros(bgArray.shape, dtype=numpy.int16)
+  masks = core.get_masks(bgArray, HI, LO)
+  in_threshold, edges = masks
+  seeds = [seed for seed in core.find_edges(point, 200, masks) or [] if seed is not None]
+  raw_path = core.find_best_path([core.build_path(seed, edges) for seed in seeds], point)
+  near = core.get_near_mask(bgArray, HI, LO, core.SMOOTH_TOLERANCE, in_threshold)
+  best_path, visited, dead_ends = core.smooth_path(raw_path, near)
+  outline = core.path_mask(visited, bgArray.shape)
+  stages = [
+      ('masks', lambda: core.get_masks(bgArray, HI, LO),
+       lambda masks: {'pixels': int(masks[0].sum()), 'edges': int(masks[1].sum())}),
+      ('find_edges', lambda: core.find_edges(point, 200, masks),
+       lambda seeds: {'seeds': sum(1 for seed in seeds or [] if seed is not None)}),
+      ('build_path', lambda: [core.build_path(seed, edges) for seed in seeds], paths_output),
+      ('moore_path', lambda: [core.moore_path(seed, edges) for seed in seeds], paths_output),
+      ('gimme_a_path', lambda: core.gimme_a_path(point, 200, HI, LO, bgArray), path_output),
+      ('smooth_path', lambda: core.smooth_path(raw_path, near), path_output),
+  ]
+  if dead_ends >= 0:
+    stages.append(('fill', lambda: core.fill_path(point, best_path, labelArray, 1, MAX_PIXELS, 1, outline),
+                   lambda fill: {'pixels': int(fill[1]), 'leaked': bool(fill[2])}))
+  stages.append(('segment_plane', lambda: core.segment_plane(bgArray, labelArray, point, HI, LO, MAX_PIXELS),
+                 plane_output))
+  return stages
+
+def propagation_stages(volume, point):
+  """Return the propagation stages over every slice of volume, from its first slice,
+  tracing every slice from scratch and tracking the contour from slice to slice.
+  """
+  def run(track):
+    return core.segment(volume, (0,) + point, 'IJ', HI, LO, MAX_PIXELS, offset=volume.shape[0] - 1, track=track)
+  return [('propagate', lambda: run(False), volume_output), ('propagate_tracked', lambda: run(True), volume_output)]
+
+def reference():
+  """Fixed workload standing for the speed of the machine, timed next to the stages.
+  Mixes a python loop over coordinates with whole array numpy operations, like the stages.
+  """
+  values = numpy.random.RandomState(0).normal(size=(512, 512))
+  total = 0
+  for row in range(512):
+    for col in range(0, 512, 4):
+      total += values.shape[0] - row + col
+  return total + numpy.sort(values, axis=None).cumsum()[-1]
+
+#
+# Measurements
+#
+
+# Key of the reference workload in the results and the baseline
+REFERENCE = 'reference'
+# Memory growth under this many bytes is never reported
+MEMORY_SLACK = 64 * 1024
+
+def measure(function, repeat):
+  """Return (median seconds, peak traced bytes, result) of function.
+  The result is that of a first untimed run; seconds is None if repeat is 0.
+  """
+  tracemalloc.start()
+  try:
+    result = function()
+    peak = tracemalloc.get_traced_memory()[1]
+  finally:
+    tracemalloc.stop()
+  times = []
+  for r in range(repeat):
+    start = time.perf_counter()
+    function()
+    times.append(time.perf_counter() - start)
+  return (float(numpy.median(times)) if times else None, peak, result)
+
+def run(sizes, volumes, repeat):
+  """Run every stage on every phantom.
+  Returns {"phantom/size/stage": {"seconds": s, "peak": bytes, "output": summary}}, with the
+  seconds of the reference workload under REFERENCE when timing.
+  """
+  results = {}
+  if repeat:
+    results[REFERENCE] = {'seconds': measure(reference, repeat)[0]}
+    print('%-40s %10.2f ms' % (REFERENCE, 1000 * results[REFERENCE]['seconds']))
+  for phantom in PHANTOMS:
+    for n in sizes:
+      stages = plane_stages(phantom(n)[0], click(phantom, n))
+      for name, function, output in stages:
+        report(results, '%s/%d/%s' % (phantom.__name__, n, name), measure(function, repeat), output)
+    for n, slices in volumes:
+      for name, function, output in propagation_stages(phantom(n, slices), click(phantom, n)):
+        report(results, '%s/%dx%d/%s' % (phantom.__name__, n, slices, name), measure(function, min(repeat, 1)),
+               output)
+  return results
+
+def report(results, key, measurement, output):
+  seconds, peak, result = measurement
+  results[key] = {'seconds': seconds, 'peak': peak, 'output': output(result)}
+  latency = '%10.2f ms' % (1000 * seconds) if seconds is not None else '%10s' % '-'
+  print('%-40s %s %10.1f KiB' % (key, latency, peak / 1024.0))
+  sys.stdout.flush()
+
+def output_changes(before, after, tolerance):
+  """Return the fields of the output after that differ from before, counts by more than tolerance."""
+  changes = []
+  for field in sorted(set(before) | set(after)):
+    a, b = before.get(field), after.get(field)
+    if isinstance(a, bool) or isinstance(b, bool) or not isinstance(a, (int, float)) or not isinstance(b, (int, float)):
+      if a != b:
+        changes.append(field)
+    elif abs(b - a) > tolerance * max(abs(a), 1):
+      changes.append(field)
+  return changes
+
+def compare(results, baseline, tolerance, memoryTolerance, outputTolerance):
+  """Print the stages whose output changed, that use more memory or, when timed, that are slower
+  than baseline by more than the tolerances, and return them.
+  Latencies are scaled by the ratio of the reference workload timings of the run and the baseline.
+  """
+  failures = []
+  scale = None
+  if REFERENCE in results:
+    if REFERENCE in baseline:
+      scale = results[REFERENCE]['seconds'] / baseline[REFERENCE]['seconds']
+      print('Reference workload x%.2f of the baseline' % scale)
+    else:
+      print('No reference workload in the baseline, latencies are not compared')
+  for key in sorted(results):
+    if key == REFERENCE or key not in baseline:
+      continue
+    before = baseline[key]
+    after = results[key]
+    if 'output' in before:
+      changes = output_changes(before['output'], after['output'], outputTolerance)
+      if changes:
+        failures.append(key)
+        print('OUTPUT     %-40s %s -> %s' % (key, json.dumps(before['output'], sort_keys=True),
+                                              json.dumps(after['output'], sort_keys=True)))
+    if after['peak'] > memoryTolerance * before['peak'] and after['peak'] - before['peak'] > MEMORY_SLACK:
+      failures.append(key)
+      print('MEMORY     %-40s %10.1f KiB -> %10.1f KiB' % (key, before['peak'] / 1024.0, after['peak'] / 1024.0))
+    if scale is not None:
+      expected = scale * before['seconds']
+      seconds = after['seconds']
+      # Ignore noise on stages that take well under a millisecond
+      if seconds > tolerance * expected and seconds - expected > 0.001:
+        failures.append(key)
+        print('REGRESSION %-40s %10.2f ms -> %10.2f ms (x%.2f)' % (key, 1000 * expected, 1000 * seconds,
+                                                                   seconds / expected))
+  return failures
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('--quick', action='store_true', help='only run the smallest phantoms')
+  parser.add_argument('--repeat', type=int, default=5, help='timed runs per stage, the median is reported')
+  parser.add_argument('--no-timing', action='store_true',
+                      help='only compare outputs and memory, for runs on shared or busy machines')
+  parser.add_argument('--baseline', default=BASELINE, help='baseline JSON file to compare against')
+  parser.add_argument('--save-baseline', action='store_true', help='write the results to the baseline file')
+  parser.add_argument('--tolerance', type=float, default=2.0,
+                      help='slowdown factor, relative to the reference workload, reported as a regression')
+  parser.add_argument('--memory-tolerance', type=float, default=1.5,
+                      help='peak memory growth factor reported as a regression')
+  parser.add_argument('--output-tolerance', type=float, default=0.01,
+                      help='relative change of an output count reported as a regression')
+  args = parser.parse_args(argv)
+  if args.save_baseline and args.no_timing:
+    parser.error('--save-baseline needs the timings')
+  repeat = 0 if args.no_timing else args.repeat
+
+  if args.quick:
+    results = run(QUICK_SIZES, QUICK_VOLUMES, repeat)
+  else:
+    results = run(SIZES, VOLUMES, repeat)
+
+  if args.save_baseline:
+    baseline = {}
+    if os.path.exists(args.baseline):
+      with open(args.baseline) as f:
+        baseline = json.load(f)
+    baseline.update(results)
+    with open(args.baseline, 'w') as f:
+      json.dump(baseline, f, indent=1, sort_keys=True)
+    print('Saved baseline to %s' % args.baseline)
+    return 0
+  if not os.path.exists(args.baseline):
+    print('No baseline at %s, run with --save-baseline to create one' % args.baseline)
+    return 0
+  with open(args.baseline) as f:
+    baseline = json.load(f)
+  return 1 if compare(results, baseline, args.tolerance, args.memory_tolerance, args.output_tolerance) else 0
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,352 @@
+"""Unit tests of TraceAndSelectLib, the Slicer-independent core of the TraceAndSelect effect.
+
+Runs in plain CPython with numpy:
+
+    python TraceAndSelectCoreTest.py
+"""
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from TraceAndSelectLib import core
+
+# Thresholds of bone mode
+HI = 2799
+LO = 250
+
+def ring_plane(n=64, inner=12, outer=20):
+  """Bone ring around a marrow cavity."""
+  yy, xx = numpy.mgrid[0:n, 0:n]
+  d = numpy.hypot(yy - n // 2, xx - n // 2)
+  return numpy.where((d >= inner) & (d <= outer), 1000, 40).astype(numpy.int16)
+
+def star_plane(n=64):
+  """Non-convex five pointed star, cut off by the edge of the plane on one side."""
+  yy, xx = numpy.mgrid[0:n, 0:n]
+  center = (n // 2, n // 2 + 10)
+  angle = numpy.arctan2(yy - center[0], xx - center[1])
+  d = numpy.hypot(yy - center[0], xx - center[1])
+  return numpy.where(d <= 0.3 * n * (1 + 0.5 * numpy.sin(5 * angle)), 1000, 40).astype(numpy.int16)
+
+def ring_volume(slices=20, n=64):
+  """Ring drifting one pixel every other slice, to propagate through."""
+  volume = numpy.zeros((slices, n, n), dtype=numpy.int16)
+  for s in range(slices):
+    volume[s] = numpy.roll(ring_plane(n), s // 2, axis=1)
+  return volume
+
+def edge_pixels(edges):
+  return [tuple(int(v) for v in pixel) for pixel in numpy.argwhere(edges)]
+
+def square_path(top, left, size):
+  """Closed path around the border of a size x size square, clockwise from its top left corner."""
+  bottom, right = top + size - 1, left + size - 1
+  path = [(top, col) for col in range(left, right)]
+  path += [(row, right) for row in range(top, bottom)]
+  path += [(bottom, col) for col in range(right, left, -1)]
+  path += [(row, left) for row in range(bottom, top, -1)]
+  return path + [(top, left)]
+
+class TracerTest(unittest.TestCase):
+
+  def assertClosed(self, path, start, edges):
+    points, visited, quality = path
+    self.assertGreaterEqual(quality, 0, "no path from %s" % (start,))
+    self.assertEqual(points[0], start)
+    self.assertTrue(core.path_closed(points), "path from %s is not closed" % (start,))
+    for a, b in zip(points, points[1:]):
+      self.assertLessEqual(max(abs(a[0] - b[0]), abs(a[1] - b[1])), 1)
+    self.assertTrue(all(edges[p] for p in points))
+    self.assertEqual(len(set(visited)), len(visited))
+
+  def assertTracesEveryEdge(self, plane, trace):
+    edges = core.get_masks(plane, HI, LO)[1]
+    for start in edge_pixels(edges):
+      self.assertClosed(trace(start, edges), start, edges)
+
+  def test_moore_ring(self):
+    self.assertTracesEveryEdge(ring_plane(), core.moore_path)
+
+  def test_moore_star(self):
+    self.assertTracesEveryEdge(star_plane(), core.moore_path)
+
+  def test_dfs_ring(self):
+    self.assertTracesEveryEdge(ring_plane(), core.build_path)
+
+  def test_dfs_star(self):
+    self.assertTracesEveryEdge(star_plane(), core.build_path)
+
+  def test_moore_isolated_pixel(self):
+    edges = numpy.zeros((8, 8), dtype=bool)
+    edges[4, 4] = True
+    self.assertEqual(core.moore_path((4, 4), edges), ([], [], -1))
+    self.assertEqual(core.moore_path((2, 2), edges), ([], [], -1))
+
+  def test_tracers_enclose_the_same_area(self):
+    plane = ring_plane()
+    edges = core.get_masks(plane, HI, LO)[1]
+    start = core.find_edges((32, 32), 200, core.get_masks(plane, HI, LO))[0]
+    areas = [core.path_shape(trace(start, edges)[0])[1] for trace in (core.build_path, core.moore_path)]
+    self.assertAlmostEqual(areas[0], areas[1])
+
+class ScanlineFillTest(unittest.TestCase):
+
+  def setUp(self):
+    self.path = square_path(2, 3, 10)
+    self.barrier = core.path_mask(self.path, (16, 16))
+    self.extrema = core.get_extrema(self.path)
+    self.changed = numpy.ones((16, 16), dtype=bool)
+
+  def test_fills_inside(self):
+    region, pixelsSet, leaked = core.scanline_fill((5, 5), self.barrier, self.extrema, 1000, self.changed)
+    self.assertFalse(leaked)
+    self.assertEqual(pixelsSet, 64)
+    self.assertTrue(region[3:11, 4:12].all())
+    self.assertEqual(region.sum(), 64)
+
+  def test_counts_changed_pixels_only(self):
+    self.changed[3:11, 4:8] = False
+    region, pixelsSet, leaked = core.scanline_fill((5, 5), self.barrier, self.extrema, 1000, self.changed)
+    self.assertEqual((pixelsSet, region.sum()), (32, 64))
+
+  def test_leaks_through_a_gap(self):
+    self.barrier[6, 3] = False
+    region, pixelsSet, leaked = core.scanline_fill((5, 5), self.barrier, self.extrema, 1000, self.changed)
+    self.assertTrue(leaked)
+
+  def test_stops_over_max_pixels(self):
+    region, pixelsSet, leaked = core.scanline_fill((5, 5), self.barrier, self.extrema, 20, self.changed)
+    self.assertFalse(leaked)
+    self.assertGreater(pixelsSet, 20)
+    self.assertLess(pixelsSet, 64)
+
+  def test_seed_on_barrier(self):
+    region, pixelsSet, leaked = core.scanline_fill((2, 3), self.barrier, self.extrema, 1000, self.changed)
+    self.assertEqual((region.sum(), pixelsSet, leaked), (0, 0, False))
+
+class FillOutlineTest(unittest.TestCase):
+
+  def setUp(self):
+    self.path = square_path(20, 30, 10)
+    self.labelArray = numpy.zeros((64, 64), dtype=numpy.int16)
+
+  def fill(self, point, path=None, maxPixels=1000):
+    path = self.path if path is None else path
+    return core.fill_outline(point, path, path, self.labelArray, 1, maxPixels, 1, LO)
+
+  def test_fill(self):
+    result, error = self.fill((24, 35))
+    self.assertIsNone(error)
+    mask, window, best_path, mean, count, lo = result
+    self.assertEqual(window, (slice(20, 30), slice(30, 40)))
+    self.assertTrue(mask.all())
+    self.assertEqual(mask.shape, (10, 10))
+    self.assertEqual(count, 64)
+    self.assertEqual((mean[0] / count, mean[1] / count), (24.5, 34.5))
+
+  def test_open_path(self):
+    self.assertEqual(self.fill((24, 35), self.path[:-5]), (None, core.ERROR_OPEN_PATH))
+
+  def test_leak(self):
+    self.assertEqual(self.fill((24, 50)), (None, core.ERROR_LEAKED))
+
+  def test_too_many_pixels(self):
+    self.assertEqual(self.fill((24, 35), maxPixels=50), (None, core.ERROR_TOO_MANY_PIXELS.format(50)))
+
+  def test_filled_pixels_count_once(self):
+    self.labelArray[20:30, 30:40] = 1
+    result, error = self.fill((24, 35), maxPixels=0)
+    self.assertIsNone(error)
+
+class SweepTest(unittest.TestCase):
+
+  def test_levels_match_masks(self):
+    plane = (ring_plane() + numpy.random.RandomState(0).normal(0, 100, (64, 64))).astype(numpy.int16)
+    levels = core.get_sweep_levels(plane, HI, LO, core.SWEEP_STEP, core.SWEEP_LEVELS)
+    for level in range(core.SWEEP_LEVELS):
+      expected = core.get_masks(plane, HI, LO - level * core.SWEEP_STEP)
+      for mask, expectedMask in zip(core.sweep_masks(levels, level), expected):
+        self.assertTrue((mask == expectedMask).all(), "level %d" % level)
+
+class LabelDeltaTest(unittest.TestCase):
+
+  def test_swap_undoes_and_redoes(self):
+    labelArray = numpy.zeros((4, 16, 16), dtype=numpy.int16)
+    labelArray[1, 2:6, 2:6] = 7
+    before = labelArray.copy()
+    delta = core.LabelDelta()
+    mask = numpy.zeros((16, 16), dtype=bool)
+    mask[3:9, 4:10] = True
+    for index in (1, 2):
+      self.assertTrue(core.write_plane(labelArray, core.plane_index(0, index), mask, 3, delta))
+    # Planes written twice keep their values from before the first write
+    self.assertTrue(core.write_plane(labelArray, core.plane_index(0, 1), numpy.roll(mask, 2, axis=1), 5, delta))
+    self.assertFalse(core.write_plane(labelArray, core.plane_index(0, 3), numpy.zeros((16, 16), bool), 5, delta))
+    self.assertEqual(len(delta.regions), 3)
+    after = labelArray.copy()
+    delta.swap(labelArray)
+    self.assertTrue((labelArray == before).all())
+    delta.swap(labelArray)
+    self.assertTrue((labelArray == after).all())
+
+  def test_write_box(self):
+    labelArray = numpy.zeros((16, 4, 16), dtype=numpy.int16)
+    delta = core.LabelDelta()
+    mask = numpy.zeros((6, 8), dtype=bool)
+    mask[1:3, 2:5] = True
+    box = core.box_index(core.plane_index(1, 2), (slice(5, 11), slice(4, 12)))
+    self.assertTrue(core.write_plane(labelArray, box, mask, 3, delta))
+    self.assertEqual(delta.regions[0][0], (slice(6, 8), 2, slice(6, 9)))
+    self.assertTrue((labelArray[6:8, 2, 6:9] == 3).all())
+    self.assertEqual(numpy.count_nonzero(labelArray), 6)
+
+class SliceCacheTest(unittest.TestCase):
+
+  def key(self, name, nodeID='vtkMRMLScalarVolumeNode1', mtime=10):
+    return (nodeID, mtime, 'IJ', 3, name)
+
+  def test_hits_and_misses(self):
+    cache = core.SliceCache()
+    self.assertIsNone(cache.get(self.key('masks')))
+    value = numpy.zeros(100, dtype=numpy.uint8)
+    self.assertIs(core.cached(cache, self.key('masks'), lambda: value), value)
+    self.assertIs(core.cached(cache, self.key('masks'), lambda: None), value)
+    self.assertEqual((cache.hits, cache.misses), (1, 2))
+    self.assertEqual(cache.bytes, 100)
+
+  def test_evicts_least_recently_used(self):
+    cache = core.SliceCache(maxBytes=300)
+    for name in ('a', 'b', 'c'):
+      cache.put(self.key(name), numpy.zeros(100, dtype=numpy.uint8))
+    cache.get(self.key('a'))
+    cache.put(self.key('d'), numpy.zeros(100, dtype=numpy.uint8))
+    self.assertEqual([key[-1] for key in cache.entries], ['c', 'a', 'd'])
+    self.assertEqual(cache.bytes, 300)
+    # Entries larger than the whole cache are not kept, and evict nothing
+    cache.put(self.key('e'), numpy.zeros(400, dtype=numpy.uint8))
+    self.assertIsNone(cache.get(self.key('e')))
+    self.assertEqual(len(cache.entries), 3)
+
+  def test_validate_drops_changed_volume(self):
+    cache = core.SliceCache()
+    cache.validate('vtkMRMLScalarVolumeNode1', 10)
+    cache.put(self.key('masks'), numpy.zeros(100, dtype=numpy.uint8))
+    cache.put(self.key('masks', 'vtkMRMLScalarVolumeNode2'), numpy.zeros(100, dtype=numpy.uint8))
+    cache.validate('vtkMRMLScalarVolumeNode1', 10)
+    self.assertEqual(len(cache.entries), 2)
+    cache.validate('vtkMRMLScalarVolumeNode1', 11)
+    self.assertEqual(list(cache.entries), [self.key('masks', 'vtkMRMLScalarVolumeNode2')])
+    self.assertEqual(cache.bytes, 100)
+
+class BestPathTest(unittest.TestCase):
+
+  def setUp(self):
+    masks = core.get_masks(star_plane(), HI, LO)
+    self.in_threshold = masks[0]
+    self.star = core.build_path((32, 59), masks[1])
+
+  def test_star_contains_its_pixels(self):
+    shape = core.path_shape(self.star[0])
+    for row in range(64):
+      for col in range(64):
+        self.assertEqual(core.polygon_contains(shape, (row, col)), self.in_threshold[row, col], (row, col))
+
+  def test_largest_enclosing_path(self):
+    square = square_path(28, 38, 9)
+    box = square_path(20, 50, 12)
+    paths = [(square, square, 0), self.star, (box, box, 0)]
+    self.assertIs(core.find_best_path(paths, (32, 42)), self.star)
+    # Between two arms of the star, inside its bounding box but not inside the star
+    self.assertIs(core.find_best_path(paths, (27, 56)), paths[2])
+    self.assertEqual(core.find_best_path(paths, (5, 5)), ([], [], -1))
+
+class PathIndexTest(unittest.TestCase):
+
+  def test_owners(self):
+    edges = core.get_masks(ring_plane(), HI, LO)[1]
+    index = core.PathIndex(edges.shape)
+    start = core.find_edges((32, 32), 200, core.get_masks(ring_plane(), HI, LO))[0]
+    path = core.build_path(start, edges)
+    self.assertEqual(index.add(start, path), 1)
+    self.assertIs(index.path(1), path)
+    self.assertEqual(index.shape(1)[1], core.path_shape(path[0])[1])
+    self.assertTrue(all(index.owner[point] == 1 for point in path[0]))
+    self.assertEqual(index.owner[32, 32], 0)
+    self.assertEqual(index.add((0, 0), ([], [], -1)), -1)
+    self.assertEqual(index.owner[0, 0], -1)
+    self.assertEqual(len(index.paths), 1)
+
+class PropagateTest(unittest.TestCase):
+
+  def setUp(self):
+    self.volume = ring_volume()
+    self.labelArray = numpy.zeros(self.volume.shape, dtype=numpy.int16)
+    result, error = core.segment_plane(self.volume[0], self.labelArray[0], (32, 32), HI, LO, 10000)
+    self.assertIsNone(error)
+    self.labelArray[0][result[1]][result[0]] = 1
+    self.start = result[2:5]
+
+  def propagate(self, function, **kwargs):
+    labelArray = self.labelArray.copy()
+    outcome = function(self.volume, labelArray, (0, 32, 32), 'IJ', 19, *self.start, hi=HI, lo=LO,
+                       maxPixels=10000, **kwargs)
+    return labelArray, outcome
+
+  def test_serial(self):
+    labelArray, outcome = self.propagate(core.propagate)
+    self.assertEqual(outcome, (19, 19, None))
+    self.assertTrue(all(labelArray[s].any() for s in range(20)))
+
+  def test_parallel_matches_serial(self):
+    serial, outcome = self.propagate(core.propagate)
+    # 19 planes in chunks of PARALLEL_MIN_CHUNK, so that every chunk but the first is speculative
+    parallel, parallelOutcome = self.propagate(core.propagate_parallel, workers=5)
+    self.assertEqual(parallelOutcome, outcome)
+    for s in range(20):
+      self.assertTrue(core.planes_agree(serial[s], parallel[s], core.PARALLEL_MATCH))
+
+  def test_parallel_cancel(self):
+    planes = []
+    labelArray, outcome = self.propagate(core.propagate_parallel, progress=lambda visited: visited > 5,
+                                         commit=lambda planeIndex, mask: planes.append(planeIndex[0]))
+    self.assertEqual(outcome, (5, 5, None))
+    self.assertEqual(planes, [1, 2, 3, 4, 5])
+
+class WorkerExecutableTest(unittest.TestCase):
+
+  def setUp(self):
+    self.executable = sys.executable
+    self.folder = tempfile.mkdtemp()
+
+  def tearDown(self):
+    sys.executable = self.executable
+    shutil.rmtree(self.folder)
+
+  def touch(self, *names):
+    path = os.path.join(self.folder, *names)
+    if not os.path.isdir(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+    open(path, 'w').close()
+    return path
+
+  def test_python(self):
+    self.assertEqual(core.worker_executable(), self.executable)
+
+  def test_slicer_application(self):
+    sys.executable = self.touch('bin', 'SlicerApp-real')
+    self.assertIsNone(core.worker_executable())
+    self.assertFalse(core.parallel_available())
+    python = self.touch('bin', 'PythonSlicer')
+    self.assertEqual(core.worker_executable(), python)
+
+  def test_slicer_launcher(self):
+    sys.executable = self.touch('Slicer')
+    python = self.touch('bin', 'PythonSlicer')
+    self.assertEqual(core.worker_executable(), python)
+
+if __name__ == '__main__':
+  unittest.main()
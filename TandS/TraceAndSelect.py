@@ -6,6 +6,21 @@ from EditorLib.EditOptions import EditOptions
 from EditorLib import EditUtil
 from EditorLib import LabelEffect
 import math
+import time
+import threading
+try:
+  import queue
+except ImportError:
+  import Queue as queue
+from TraceAndSelectLib import PLANE_AXES, PLANE_INDEXES, SMOOTH_TOLERANCE, TRACERS, TRACER_NAMES
+from TraceAndSelectLib import LabelDelta, SliceCache, StageTimer, box_index, parallel_available, plane_index
+from TraceAndSelectLib import plane_point, timed, worker_pool
+from TraceAndSelectLib import propagation_offset, propagate, segment_plane, write_plane
+
+# Minimum time between two label map updates while propagating
+UPDATE_SECONDS = 0.5
+# Interval at which the planes propagated on the worker thread are written to the label map
+POLL_MILLISECONDS = 50
 
 #
 # The Editor Extension itself.
@@ -62,6 +77,51 @@ class TraceAndSelectOptions(EditorLib.LabelEffectOptions):
     self.frame.layout().addWidget(self.preview)
     ## End preview checkbox
 
+    ## Parallel propagation checkbox
+    self.parallel = qt.QCheckBox("Parallel propagation", self.frame)
+    self.parallel.setToolTip("Trace long multi-slice fills on all processor cores.")
+    self.frame.layout().addWidget(self.parallel)
+    self.widgets.append(self.parallel)
+    ## End parallel propagation checkbox
+
+    ## Follow propagation checkbox
+    self.follow = qt.QCheckBox("Follow propagation", self.frame)
+    self.follow.setToolTip("Move the clicked view along with the slice being filled instead of once at the end.")
+    self.frame.layout().addWidget(self.follow)
+    self.widgets.append(self.follow)
+    ## End follow propagation checkbox
+
+    ## Contour tracking checkbox
+    self.tracking = qt.QCheckBox("Track contours between slices", self.frame)
+    self.tracking.setToolTip("Look for each propagated contour near the one of the slice before, and only search the whole slice when it is lost.")
+    self.frame.layout().addWidget(self.tracking)
+    self.widgets.append(self.tracking)
+    ## End contour tracking checkbox
+
+    ## Stage timing checkbox
+    self.timing = qt.QCheckBox("Show stage timings", self.frame)
+    self.timing.setToolTip("Time each stage of a fill and list the timings under the status message.")
+    self.frame.layout().addWidget(self.timing)
+    self.widgets.append(self.timing)
+    ## End stage timing checkbox
+
+    ## Tracing engine selection
+    self.tracerFrame = qt.QFrame(self.frame)
+    self.tracerFrame.setLayout(qt.QHBoxLayout())
+    self.frame.layout().addWidget(self.tracerFrame)
+    self.widgets.append(self.tracerFrame)
+    self.tracerLabel = qt.QLabel("Tracing engine:", self.tracerFrame)
+    self.tracerLabel.setToolTip("Depth-first backtracks at every dead end, Moore neighbour walks the boundary once.")
+    self.tracerFrame.layout().addWidget(self.tracerLabel)
+    self.widgets.append(self.tracerLabel)
+    self.tracerComboBox = qt.QComboBox(self.tracerFrame)
+    self.tracerComboBox.setToolTip("Depth-first backtracks at every dead end, Moore neighbour walks the boundary once.")
+    for tracer in TRACERS:
+      self.tracerComboBox.addItem(TRACER_NAMES[tracer])
+    self.tracerFrame.layout().addWidget(self.tracerComboBox)
+    self.widgets.append(self.tracerComboBox)
+    ## End tracing engine selection
+
 
 
 
@@ -109,6 +169,24 @@ class TraceAndSelectOptions(EditorLib.LabelEffectOptions):
     self.offsetvalueFrame.layout().addWidget(self.offsetvalueSpinBox)
     self.widgets.append(self.offsetvalueSpinBox)
     ## End offset value selection
+
+    ## For propagating the other way from the same click
+    self.oppositeOffsetFrame = qt.QFrame(self.frame)
+    self.oppositeOffsetFrame.setLayout(qt.QHBoxLayout())
+    self.frame.layout().addWidget(self.oppositeOffsetFrame)
+    self.widgets.append(self.oppositeOffsetFrame)
+    self.oppositeOffsetLabel = qt.QLabel("Opposite Offset:", self.oppositeOffsetFrame)
+    self.oppositeOffsetLabel.setToolTip("Also propagate this many slices in the other direction, at the same time")
+    self.oppositeOffsetFrame.layout().addWidget(self.oppositeOffsetLabel)
+    self.widgets.append(self.oppositeOffsetLabel)
+    self.oppositeOffsetSpinBox = qt.QDoubleSpinBox(self.oppositeOffsetFrame)
+    self.oppositeOffsetSpinBox.setToolTip("Also propagate this many slices in the other direction, at the same time")
+    self.oppositeOffsetSpinBox.minimum = 0
+    self.oppositeOffsetSpinBox.maximum = 1000
+    self.oppositeOffsetSpinBox.suffix = ""
+    self.oppositeOffsetFrame.layout().addWidget(self.oppositeOffsetSpinBox)
+    self.widgets.append(self.oppositeOffsetSpinBox)
+    ## End opposite offset selection
  
     
     self.maxPixelsFrame = qt.QFrame(self.frame)
@@ -127,6 +205,22 @@ class TraceAndSelectOptions(EditorLib.LabelEffectOptions):
     self.maxPixelsFrame.layout().addWidget(self.maxPixelsSpinBox)
     self.widgets.append(self.maxPixelsSpinBox)
 
+    self.smoothToleranceFrame = qt.QFrame(self.frame)
+    self.smoothToleranceFrame.setLayout(qt.QHBoxLayout())
+    self.frame.layout().addWidget(self.smoothToleranceFrame)
+    self.widgets.append(self.smoothToleranceFrame)
+    self.smoothToleranceLabel = qt.QLabel("Smoothing tolerance:", self.smoothToleranceFrame)
+    self.smoothToleranceLabel.setToolTip("Pixels next to the outline within this distance of the threshold are added to it")
+    self.smoothToleranceFrame.layout().addWidget(self.smoothToleranceLabel)
+    self.widgets.append(self.smoothToleranceLabel)
+    self.smoothToleranceSpinBox = qt.QDoubleSpinBox(self.smoothToleranceFrame)
+    self.smoothToleranceSpinBox.setToolTip("Pixels next to the outline within this distance of the threshold are added to it")
+    self.smoothToleranceSpinBox.minimum = 0
+    self.smoothToleranceSpinBox.maximum = 5000
+    self.smoothToleranceSpinBox.suffix = ""
+    self.smoothToleranceFrame.layout().addWidget(self.smoothToleranceSpinBox)
+    self.widgets.append(self.smoothToleranceSpinBox)
+
 
     # Help Browser
     self.helpBrowser = qt.QPushButton("Visit the Webpage")
@@ -145,13 +239,22 @@ class TraceAndSelectOptions(EditorLib.LabelEffectOptions):
     # self.thresholdPaint.hide()
     self.connections.append( 
         (self.maxPixelsSpinBox, 'valueChanged(double)', self.onMaxPixelsSpinBoxChanged) )
+    self.connections.append( 
+        (self.smoothToleranceSpinBox, 'valueChanged(double)', self.onSmoothToleranceSpinBoxChanged) )
     self.connections.append( (self.preview, "clicked()", self.onPreviewChanged ) )
+    self.connections.append( (self.parallel, "clicked()", self.onParallelChanged ) )
+    self.connections.append( (self.follow, "clicked()", self.onFollowChanged ) )
+    self.connections.append( (self.tracking, "clicked()", self.onTrackingChanged ) )
+    self.connections.append( (self.timing, "clicked()", self.onTimingChanged ) )
+    self.connections.append( (self.tracerComboBox, "currentIndexChanged(int)", self.onTracerChanged ) )
 
     self.connections.append( (self.tissueRadioButton, "clicked()", self.onTissueButtonChanged ) )
     self.connections.append( (self.boneRadioButton, "clicked()", self.onBoneButtonChanged ) )
 
     self.connections.append( 
       (self.offsetvalueSpinBox, 'valueChanged(double)', self.onOffsetValueSpinBoxChanged) )
+    self.connections.append( 
+      (self.oppositeOffsetSpinBox, 'valueChanged(double)', self.onOffsetValueSpinBoxChanged) )
     self.connections.append( (self.thresh, "valuesChanged(double,double)", self.onThreshValuesChange ) )
 
     self.connections.append((self.helpBrowser, "clicked()", self.onHelpBrowserPressed))
@@ -182,9 +285,17 @@ class TraceAndSelectOptions(EditorLib.LabelEffectOptions):
     defaults = (
       ("maxPixels", "25000"),
       ("offsetvalue", '0'),
+      ("oppositeOffset", '0'),
       ("preview", "0"),
       ("paintThresholdMin", "250"),
       ("paintThresholdMax", "2799"),
+      ("modifiedInterval", "1"),
+      ("parallel", "0"),
+      ("follow", "0"),
+      ("tracking", "0"),
+      ("tracer", "dfs"),
+      ("smoothTolerance", "125"),
+      ("timing", "0"),
     )
     for d in defaults:
       param = "TraceAndSelect,"+d[0]
@@ -213,12 +324,26 @@ class TraceAndSelectOptions(EditorLib.LabelEffectOptions):
                 float(self.parameterNode.GetParameter("TraceAndSelect,paintThresholdMin")) )
     self.thresh.setMaximumValue(
                 float(self.parameterNode.GetParameter("TraceAndSelect,paintThresholdMax")) )
-    self.errorMessageFrame.setText(str(self.parameterNode.GetParameter("TraceAndSelect,errorMessage")))
+    errorMessage = str(self.parameterNode.GetParameter("TraceAndSelect,errorMessage"))
+    timing = int(self.parameterNode.GetParameter("TraceAndSelect,timing") or 0)
+    timings = self.parameterNode.GetParameter("TraceAndSelect,timings")
+    if timing and timings:
+      errorMessage += "\n\nStage timings:\n" + timings
+    self.errorMessageFrame.setText(errorMessage)
     self.errorMessageFrame.setStyleSheet("QTextEdit {color:blue}")
     self.errorMessageFrame.setStyleSheet(self.parameterNode.GetParameter("TraceAndSelect,errorMessageColor"))
     self.maxPixelsSpinBox.setValue( float(self.parameterNode.GetParameter("TraceAndSelect,maxPixels")) )
+    self.smoothToleranceSpinBox.setValue( float(self.parameterNode.GetParameter("TraceAndSelect,smoothTolerance")) )
     self.preview.setChecked( int(self.parameterNode.GetParameter("TraceAndSelect,preview")) )
+    self.parallel.setChecked( int(self.parameterNode.GetParameter("TraceAndSelect,parallel")) )
+    self.follow.setChecked( int(self.parameterNode.GetParameter("TraceAndSelect,follow") or 0) )
+    self.tracking.setChecked( int(self.parameterNode.GetParameter("TraceAndSelect,tracking") or 0) )
+    self.timing.setChecked( timing )
+    tracer = self.parameterNode.GetParameter("TraceAndSelect,tracer")
+    if tracer in TRACERS:
+      self.tracerComboBox.setCurrentIndex(TRACERS.index(tracer))
     self.offsetvalueSpinBox.setValue( float(self.parameterNode.GetParameter("TraceAndSelect,offsetvalue")))
+    self.oppositeOffsetSpinBox.setValue( float(self.parameterNode.GetParameter("TraceAndSelect,oppositeOffset") or 0))
     self.connectWidgets()
                                             
   def onToleranceSpinBoxChanged(self,value):
@@ -231,6 +356,11 @@ class TraceAndSelectOptions(EditorLib.LabelEffectOptions):
       return
     self.updateMRMLFromGUI()
 
+  def onSmoothToleranceSpinBoxChanged(self,value):
+    if self.updatingGUI:
+      return
+    self.updateMRMLFromGUI()
+
   def onOffsetValueSpinBoxChanged(self,value):
     if self.updatingGUI:
       return
@@ -241,6 +371,31 @@ class TraceAndSelectOptions(EditorLib.LabelEffectOptions):
       return
     self.updateMRMLFromGUI()
 
+  def onParallelChanged(self):
+    if self.updatingGUI:
+      return
+    self.updateMRMLFromGUI()
+
+  def onFollowChanged(self):
+    if self.updatingGUI:
+      return
+    self.updateMRMLFromGUI()
+
+  def onTrackingChanged(self):
+    if self.updatingGUI:
+      return
+    self.updateMRMLFromGUI()
+
+  def onTimingChanged(self):
+    if self.updatingGUI:
+      return
+    self.updateMRMLFromGUI()
+
+  def onTracerChanged(self, index):
+    if self.updatingGUI:
+      return
+    self.updateMRMLFromGUI()
+
   def onHelpBrowserPressed(self):
     qt.QDesktopServices.openUrl(qt.QUrl("https://fastslice.github.io/"))
                             
@@ -274,12 +429,31 @@ class TraceAndSelectOptions(EditorLib.LabelEffectOptions):
         self.parameterNode.SetParameter( "TraceAndSelect,preview", "1" )
     else:
         self.parameterNode.SetParameter( "TraceAndSelect,preview", "0" )
+    if self.parallel.checked:
+        self.parameterNode.SetParameter( "TraceAndSelect,parallel", "1" )
+    else:
+        self.parameterNode.SetParameter( "TraceAndSelect,parallel", "0" )
+    if self.follow.checked:
+        self.parameterNode.SetParameter( "TraceAndSelect,follow", "1" )
+    else:
+        self.parameterNode.SetParameter( "TraceAndSelect,follow", "0" )
+    if self.tracking.checked:
+        self.parameterNode.SetParameter( "TraceAndSelect,tracking", "1" )
+    else:
+        self.parameterNode.SetParameter( "TraceAndSelect,tracking", "0" )
+    if self.timing.checked:
+        self.parameterNode.SetParameter( "TraceAndSelect,timing", "1" )
+    else:
+        self.parameterNode.SetParameter( "TraceAndSelect,timing", "0" )
+    self.parameterNode.SetParameter( "TraceAndSelect,tracer", TRACERS[self.tracerComboBox.currentIndex] )
     self.parameterNode.SetParameter(
                 "TraceAndSelect,paintThresholdMin", str(self.thresh.minimumValue) )
     self.parameterNode.SetParameter(
                 "TraceAndSelect,paintThresholdMax", str(self.thresh.maximumValue) )
     self.parameterNode.SetParameter( "TraceAndSelect,maxPixels", str(self.maxPixelsSpinBox.value) )
+    self.parameterNode.SetParameter( "TraceAndSelect,smoothTolerance", str(self.smoothToleranceSpinBox.value) )
     self.parameterNode.SetParameter( "TraceAndSelect,offsetvalue", str(self.offsetvalueSpinBox.value) )
+    self.parameterNode.SetParameter( "TraceAndSelect,oppositeOffset", str(self.oppositeOffsetSpinBox.value) )
     self.parameterNode.SetDisableModifiedEvent(disableState)
     if not disableState:
       self.parameterNode.InvokePendingModifiedEvent()
@@ -300,11 +474,22 @@ class TraceAndSelectTool(LabelEffect.LabelEffectTool):
 
   def __init__(self, sliceWidget):
     super(TraceAndSelectTool,self).__init__(sliceWidget)
-    # create a logic instance to do the non-gui work
+    # create a logic instance to do the non-gui work, reused by every click in this view
     self.logic = TraceAndSelectLogic(self.sliceWidget.sliceLogic())
     
-    self.prevPath = []
-    self.prevFillPoint = None
+    # Result of the last right-click preview, committed as is by the next left click
+    self.previewResult = None
+
+    # Overlay showing the previewed outline, so previews never touch the label map
+    self.previewPolyData = vtk.vtkPolyData()
+    self.previewMapper = vtk.vtkPolyDataMapper2D()
+    self.previewActor = vtk.vtkActor2D()
+    self.previewMapper.SetInputData(self.previewPolyData)
+    self.previewActor.SetMapper(self.previewMapper)
+    self.previewActor.GetProperty().SetColor(1, 1, 0)
+    self.previewActor.VisibilityOff()
+    self.renderer.AddActor2D(self.previewActor)
+    self.actors.append(self.previewActor)
 
   def cleanup(self):
     super(TraceAndSelectTool,self).cleanup()
@@ -318,10 +503,8 @@ class TraceAndSelectTool(LabelEffect.LabelEffectTool):
     preview = int(node.GetParameter("TraceAndSelect,preview"))
     # Clear any saved outlines if preview has been just disabled
     if not preview:
-        if self.prevPath != []:
-            self.prevPath = []
-            self.prevFillPoint = None
-            self.undoRedo.undo()
+        if self.previewResult is not None:
+            self.clearPreview()
     
     
     # let the superclass deal with the event if it wants to
@@ -330,13 +513,11 @@ class TraceAndSelectTool(LabelEffect.LabelEffectTool):
     # LEFT CLICK
     if event == "LeftButtonPressEvent":
       xy = self.interactor.GetEventPosition()
-      sliceLogic = self.sliceWidget.sliceLogic()
-      logic = TraceAndSelectLogic(sliceLogic)
+      logic = self.logic
       logic.undoRedo = self.undoRedo
-      if self.prevPath != []:
-        logic.apply(xy, forced_path=self.prevPath, forced_point=self.prevFillPoint)
-        self.prevPath = []
-        self.prevFillPoint = None
+      if self.previewResult is not None:
+        logic.apply(xy, preview=self.previewResult)
+        self.clearPreview()
       else:
         logic.apply(xy)
       print("Got a %s at %s in %s" % (event,str(xy),self.sliceWidget.sliceLogic().GetSliceNode().GetName()))
@@ -344,28 +525,23 @@ class TraceAndSelectTool(LabelEffect.LabelEffectTool):
     # RIGHT CLICK
     elif event == "RightButtonPressEvent" and preview:
         xy = self.interactor.GetEventPosition()
-        sliceLogic = self.sliceWidget.sliceLogic()
-        logic = TraceAndSelectLogic(sliceLogic)
+        logic = self.logic
         logic.undoRedo = self.undoRedo
         # Erase stored path and remove from view
-        if self.prevPath != []:
-            self.prevPath = []
-            self.prevFillPoint = None
-            logic.undoRedo.undo()
-        # Store prevPath and prevFillPoint
-        self.prevPath, self.prevFillPoint = logic.apply(xy, 1)
+        if self.previewResult is not None:
+            self.clearPreview()
+        # Store the previewed result and draw its outline
+        self.previewResult = logic.apply(xy, 1)
+        if self.previewResult is not None:
+            self.showPreview(logic)
         print("Got a %s at %s in %s" % (event,str(xy),self.sliceWidget.sliceLogic().GetSliceNode().GetName()))
         self.abortEvent(event)
     # SLICE VIEW HAS CHANGED
     elif event == "ModifiedEvent":  # Offset was changed on one of the viewing panels
         # Erase stored path and remove from view
-        if self.prevPath != []:
-            self.prevPath = []
-            self.prevFillPoint = None
-            self.undoRedo.undo()
-            sliceLogic = self.sliceWidget.sliceLogic()
-            logic = TraceAndSelectLogic(sliceLogic)
-            logic.setErrorMessage("Previewed path was discarded.", 1)
+        if self.previewResult is not None:
+            self.clearPreview()
+            self.logic.setErrorMessage("Previewed path was discarded.", 1)
 
     else:
       pass
@@ -376,6 +552,27 @@ class TraceAndSelectTool(LabelEffect.LabelEffectTool):
       # to the view
       pass
 
+  def showPreview(self, logic):
+    """Draw the outline of the previewed path as a closed polyline over the slice view."""
+    ijk, best_path = self.previewResult[:2]
+    points = vtk.vtkPoints()
+    lines = vtk.vtkCellArray()
+    lines.InsertNextCell(len(best_path) + 1)
+    for x, y in logic.pathToXY(ijk, best_path):
+      lines.InsertCellPoint(points.InsertNextPoint(x, y, 0))
+    lines.InsertCellPoint(0)
+    self.previewPolyData.SetPoints(points)
+    self.previewPolyData.SetLines(lines)
+    self.previewPolyData.Modified()
+    self.previewActor.VisibilityOn()
+    self.sliceView.scheduleRender()
+
+  def clearPreview(self):
+    """Forget the previewed result and hide its outline."""
+    self.previewResult = None
+    self.previewActor.VisibilityOff()
+    self.sliceView.scheduleRender()
+
 
 #
 # TraceAndSelectLogic
@@ -392,9 +589,24 @@ class TraceAndSelectLogic(LabelEffect.LabelEffectLogic):
   by other code without the need for a view context.
   """
 
+  # Tracing artifacts shared by every logic instance, see SliceCache
+  sliceCache = None
+
+  # Stage timings of the running apply, None while timing is off
+  timer = None
+
+  # Logic instance whose fill is propagating on a worker thread, if any
+  running = None
+
   def __init__(self,sliceLogic):
     self.sliceLogic = sliceLogic
     self.fillMode = 'Plane'
+    # Numpy views of the volumes, kept for as long as this logic instance
+    self.volumeArrays = VolumeArrays()
+    # Progress dialog of the current propagation, if any
+    self.progress = None
+    if TraceAndSelectLogic.sliceCache is None:
+      TraceAndSelectLogic.sliceCache = SliceCache()
 
 
   ###
@@ -408,7 +620,7 @@ class TraceAndSelectLogic(LabelEffect.LabelEffectLogic):
   ##
   ###
   
-  def apply(self,xy, mode=0, forced_path=None, forced_point=None):
+  def apply(self,xy, mode=0, preview=None):
     #
     # get the parameters from MRML
     #
@@ -452,253 +664,376 @@ class TraceAndSelectLogic(LabelEffect.LabelEffectLogic):
     # Get the numpy array for the bg and label
     #
     node = EditUtil.EditUtil().getParameterNode()
+    if TraceAndSelectLogic.running is not None:
+      self.setErrorMessage("Error: the last fill is still propagating.")
+      return
     offset = float(node.GetParameter("TraceAndSelect,offsetvalue"))
     if offset != 0 and mode == 0:
+      # The maximum is set by fill once the offsets are clipped to the volume
       self.progress = qt.QProgressDialog()
       self.progress.setLabelText("Processing Slices...")
       self.progress.setCancelButtonText("Abort Fill")
       self.progress.setMinimum(0)
-      self.progress.setMaximum(abs(offset))
-      self.progress.setAutoClose(1)
-      self.progress.open()
-    return self.fill(ijk, [], mode, forced_path, forced_point)
-
-  def fill(self, ijk, optional_seeds=[], mode=0, forced_path=None, forced_point=None):
+      # Application modal, so that nothing else edits the label map or undoes while slices are written
+      self.progress.setWindowModality(qt.Qt.ApplicationModal)
+      self.progress.show()
+    # Timings are shown under the status message and kept on the parameter node
+    self.timer = StageTimer() if int(node.GetParameter("TraceAndSelect,timing") or 0) else None
+    # Slice cache counters before this click, the timings list the hits and misses of the click
+    self.cacheCounts = (self.sliceCache.hits, self.sliceCache.misses)
+    result = self.fill(ijk, [], mode, preview)
+    if TraceAndSelectLogic.running is None:
+      # The fill stopped before propagating, on an error or with nothing to propagate
+      self.closeProgress()
+      self.saveTimings()
+    return result
+
+  def fill(self, ijk, optional_seeds=[], mode=0, preview=None):
+    """Fill the clicked slice, then propagate slice by slice while there is an offset left.
+    The parameters and arrays are read once and the whole run shares one undo snapshot.
+    Tracing and filling are done by TraceAndSelectLib on the numpy arrays of the volumes.
+    In preview mode (mode 1) nothing is written; the result of the whole slice is
+    returned so that passing it back as preview commits it without retracing.
+    """
     print("Mode: %d" % mode)
-    paintOver = 1
-    mean = (0, 0)
-    count = 0
     node = EditUtil.EditUtil().getParameterNode()
     
     # Max number of pixels to fill in (does not include path)
     print("@@@MaxPixels:%s" % node.GetParameter("TraceAndSelect,maxPixels"))
-    maxPixels = float(node.GetParameter("TraceAndSelect,maxPixels"))
+    self.maxPixels = float(node.GetParameter("TraceAndSelect,maxPixels"))
+
+    # Distance from the threshold within which smoothing adds pixels next to the outline
+    self.smoothTolerance = float(node.GetParameter("TraceAndSelect,smoothTolerance") or SMOOTH_TOLERANCE)
     
     # Minimum intensity value to be detected
     print("@@@Theshold Min:%s" % node.GetParameter("TraceAndSelect,paintThresholdMin"))
-    thresholdMin = float(node.GetParameter("TraceAndSelect,paintThresholdMin"))
+    self.thresholdMin = float(node.GetParameter("TraceAndSelect,paintThresholdMin"))
     
     # Maximum intensity value to be detected
     print("@@@Theshold Max:%s" % node.GetParameter("TraceAndSelect,paintThresholdMax"))
-    thresholdMax = float(node.GetParameter("TraceAndSelect,paintThresholdMax"))
-  
+    self.thresholdMax = float(node.GetParameter("TraceAndSelect,paintThresholdMax"))
+
+    # Slices left to propagate to after the clicked one, the sign gives the direction
+    print("@@@Offset:|%s|" % node.GetParameter("TraceAndSelect,offsetvalue"))
+    self.offset = float(node.GetParameter("TraceAndSelect,offsetvalue"))
+
+    # Slices to also propagate to on the other side of the clicked one, in the opposite direction
+    self.oppositeOffset = abs(float(node.GetParameter("TraceAndSelect,oppositeOffset") or 0))
+
+    # Number of propagated slices between label map updates, 0 updates once at the end
+    self.modifiedInterval = int(float(node.GetParameter("TraceAndSelect,modifiedInterval")))
+
+    # Long propagation runs are traced on a process pool where the platform allows it
+    self.parallel = int(node.GetParameter("TraceAndSelect,parallel")) and parallel_available()
+
+    # Contour tracing engine, one of TRACERS
+    self.tracer = node.GetParameter("TraceAndSelect,tracer") or TRACERS[0]
+
+    # Follow each propagated contour from the one of the slice before, see track_plane
+    self.tracking = int(node.GetParameter("TraceAndSelect,tracking") or 0)
+
+    # Move the clicked view along with propagation, instead of once when it is over
+    self.follow = int(node.GetParameter("TraceAndSelect,follow") or 0)
     
     labelLogic = self.sliceLogic.GetLabelLayer()
-    labelNode = labelLogic.GetVolumeNode()
+    self.labelNode = labelLogic.GetVolumeNode()
     backgroundLogic = self.sliceLogic.GetBackgroundLayer()
     backgroundNode = backgroundLogic.GetVolumeNode()
 
-    import vtk.util.numpy_support, numpy
-    backgroundImage = backgroundNode.GetImageData()
-    labelImage = labelNode.GetImageData()
-    shape = list(backgroundImage.GetDimensions())
-    shape.reverse()
-    backgroundArray = vtk.util.numpy_support.vtk_to_numpy(backgroundImage.GetPointData().GetScalars()).reshape(shape)
-    labelArray = vtk.util.numpy_support.vtk_to_numpy(labelImage.GetPointData().GetScalars()).reshape(shape)
+    with timed(self.timer, 'arrays'):
+      backgroundImage = backgroundNode.GetImageData()
+      self.backgroundArray = self.volumeArrays.array(backgroundNode)
+      self.labelArray = self.volumeArrays.array(self.labelNode)
+    # Cached tracing artifacts are only valid for the current background voxels
+    self.backgroundKey = (backgroundNode.GetID(), backgroundImage.GetMTime())
+    self.sliceCache.validate(*self.backgroundKey)
 
-    ijk_reconstruction_indexes = []
     # THIS SHOULD ALWAYS BE TRUE
     # VOLUME MODE IS DISABLED BECAUSE I HAVE NO CLUE WHAT IT IS
-    original_ijk = list(ijk)
-    if self.fillMode == 'Plane':
-      # select the plane corresponding to current slice orientation
-      # for the input volume
-      ijkPlane = self.sliceIJKPlane()
-      i,j,k = ijk
-      if ijkPlane == 'JK':
-        backgroundDrawArray = backgroundArray[:,:,k]
-        labelDrawArray = labelArray[:,:,k]
-        ijk = (i, j)
-        ijk_reconstruction_indexes = (0,1)
-      if ijkPlane == 'IK':
-        backgroundDrawArray = backgroundArray[:,j,:]
-        labelDrawArray = labelArray[:,j,:]
-        ijk = (i, k)
-        ijk_reconstruction_indexes = (0, 2)
-      if ijkPlane == 'IJ':
-        backgroundDrawArray = backgroundArray[i,:,:]
-        labelDrawArray = labelArray[i,:,:]
-        ijk = (j, k)
-        ijk_reconstruction_indexes = (1,2)
-    else:
+    if self.fillMode != 'Plane':
         print("HOW DID YOU DO THAT??? WHAT DID YOU DO TO ACTIVATE VOLUME MODE???")
         self.setErrorMessage("Error: volume mode not supported.")
         return
+    # select the plane corresponding to current slice orientation
+    # for the input volume
+    self.ijkPlane = self.sliceIJKPlane()
+    axis = PLANE_AXES[self.ijkPlane]
 
-
-    # Log info about where the user clicked for debugging purposes
-    value = backgroundDrawArray[ijk]
-    print("@@@location=", ijk)
-    print("@@@value=", value)
-    
     # Get the current label that the user wishes to assign using the tool
-    label = EditUtil.EditUtil().getLabel()
-    
-    # Use lo and hi for threshold checks
-    # Easiest way to do things is check if a pixel is outside the threshold, ie.
+    self.label = EditUtil.EditUtil().getLabel()
 
-    lo = thresholdMin
-    hi = thresholdMax
-    
-    best_path = []
-    fill_point = ijk
-
-    if mode == 0 and forced_path is not None and forced_point is not None:
-        best_path = forced_path
-        fill_point = forced_point
+    if preview is not None:
+      # Everything was computed when the outline was previewed
+      ijk, best_path, mask, window, mean, count = preview
     else:
-        # Build path
-        
-        best_path, visited, dead_ends = gimme_a_path(ijk, 200, hi, lo, backgroundDrawArray,
-                                                     optional_seeds)
-        print("@@@Dead ends:", dead_ends)
-        
-        attempts = 0
-        max_attempts = 2
-        while dead_ends > 150 or dead_ends < 0 and attempts < max_attempts:
-            attempts += 1
-            lo -= 25
-            print("Lowering min tolerance to:", lo)
-            node.SetParameter("LabelEffect,paintThresholdMin", str(lo))
-            best_path, visited, dead_ends = gimme_a_path(ijk, 200, hi, lo, backgroundDrawArray,
-                                                         optional_seeds)
-            print("@@@Dead ends:", dead_ends)
-        
-        if dead_ends < 0:
-            print("@@@No path found? Weird.")
-            self.setErrorMessage("Error: could not find any suitable path.")
-            return
-        
-        # Save state before doing anything
-        self.undoRedo.saveState()
-        for pixel in visited:
-            labelDrawArray[pixel] = label
-        
-        EditUtil.EditUtil().markVolumeNodeAsModified(labelNode)
-
-        if mode == 1:  # Outline only mode
-            print("Outline made, returning.")
-            self.setErrorMessage("Preview complete. No errrors detected.\nLeft click to confirm.\nRight click to try a new outline.\nUndo to remove.", 1)
-            return (best_path, ijk)
-        
-    
-    #
-    # Fill path
-    #
-    
-    # Fill the path using a recursive search
-    toVisit = [fill_point,]
-    extrema = get_extrema(best_path)
-    # Create a map that contains the location of the pixels
-    # that have been already visited (added or considered to be added).
-    # This is required if paintOver is enabled because then we reconsider
-    # all pixels (not just the ones that have not labelled yet).
-    if paintOver:
-      labelDrawVisitedArray = numpy.zeros(labelDrawArray.shape,dtype='bool')
-
-    pixelsSet = 0
-    print("@@@FILLING PATH")
-    while toVisit != []:
-      location = toVisit.pop(0)
+      print("@@@location=", plane_point(ijk, self.ijkPlane))
+      planeIndex = plane_index(axis, ijk[axis])
+      result, error = segment_plane(self.backgroundArray[planeIndex], self.labelArray[planeIndex],
+                                    plane_point(ijk, self.ijkPlane), self.thresholdMax, self.thresholdMin,
+                                    self.maxPixels, self.label, optional_seeds, 1, self.tracer,
+                                    self.smoothTolerance, self.sliceCache,
+                                    self.backgroundKey + (self.ijkPlane, ijk[axis]), self.timer)
+      if error is not None:
+        self.setErrorMessage(error)
+        return
+      mask, window, best_path, mean, count, lo = result
+      if lo != self.thresholdMin:
+        node.SetParameter("LabelEffect,paintThresholdMin", str(lo))
+      if mode == 1:  # Outline only mode
+        print("Outline made, returning.")
+        self.setErrorMessage("Preview complete. No errrors detected.\nLeft click to confirm.\nRight click to try a new outline.", 1)
+        return (ijk, best_path, mask, window, mean, count)
+
+    # One undo checkpoint covers the whole run
+    with timed(self.timer, 'undo'):
+      self.delta = self.saveDelta()
+    # Whether anything was written since the label map was last updated
+    self.dirty = False
+    self.lastUpdate = time.time()
+    self.updatedSlices = 0
+    self.dirty = write_plane(self.labelArray, box_index(plane_index(axis, ijk[axis]), window), mask, self.label,
+                             self.delta)
+    self.slicesDone = 1
+
+    self.keepOffset = self.offset != 0
+    self.direction = int(math.copysign(1, self.offset))
+    self.startIJK = ijk
+    # Slices to propagate to on each side of the clicked one, without leaving the volume
+    self.offsets = [propagation_offset(self.backgroundArray.shape, ijk, self.ijkPlane, self.offset), 0]
+    if self.offset != 0:
+      self.offsets[1] = propagation_offset(self.backgroundArray.shape, ijk, self.ijkPlane,
+                                           -self.direction * self.oppositeOffset)
+    self.offset = self.offsets[0]
+    if self.progress is not None:
+      self.progress.setMaximum(int(sum(abs(offset) for offset in self.offsets)))
+    if self.offsets == [0, 0]:
+      self.setErrorMessage("Fill complete. No errors detected.", 1)
+      self.finishFill()
+      return
+    if self.parallel:
+      # Start the worker processes here on the main thread, not from the propagation threads
+      worker_pool()
+    self.startPropagation(ijk, best_path, mean, count)
+
+  def startPropagation(self, ijk, best_path, mean, count):
+    """Propagate the fill of the slice through ijk on worker threads, one per direction
+    in self.offsets, which run concurrently. The workers post the filled planes to
+    self.results instead of writing them; onPropagationTimer writes them to the label
+    map on the main thread in batches, all into the same undo checkpoint.
+    Canceling stops the workers before their next slice and keeps every slice they finished.
+    """
+    self.results = queue.Queue()
+    self.canceled = threading.Event()
+    self.visited = [0, 0]
+    self.outcomes = [None, None]
+    self.workers = []
+
+    def run(front):
+      # Parallel propagation calls progress again with the same count while it waits for a slice
+      last = [0]
+
+      def progress(visited):
+        if visited != last[0]:
+          last[0] = visited
+          self.results.put(('progress', front, visited))
+        return self.canceled.is_set()
+
+      def commit(planeIndex, mask):
+        self.results.put(('plane', front, planeIndex, mask))
 
       try:
-        l = fetch_val(labelDrawArray, location)
-        b = fetch_val(backgroundDrawArray, location)
-      except IndexError:
-        continue
-      if (not paintOver and l != 0):
-        # label filled already and not painting over, leave it alone
-        continue
-      try:
-        if (paintOver and l == label):
-          temp1 = mean[0] + location[0]
-          temp2 = mean[1] + location[1]
-          mean = (temp1, temp2)
-          count += 1
-          # label is the current one, but maybe it was filled with another high/low value,
-          # so we have to visit it once (and only once) in this session, too
-          if  labelDrawVisitedArray[location]:
-            # visited already, so don't try to fill it again
-            continue
-          else:
-            # we'll visit this pixel now, so mark it as visited
-            labelDrawVisitedArray[location] = True
-      except ValueError:
-        print("@@@VALUE ERROR!", l)
-        print("@@@Location: ", location)
-        print("@@@fill_point:", fill_point)
-        print("@@@toVisit:", toVisit)
-        continue
-      if location in best_path:
+        result = propagate(self.backgroundArray, self.labelArray, ijk, self.ijkPlane, self.offsets[front],
+                           best_path, mean, count, self.thresholdMax, self.thresholdMin,
+                           self.maxPixels, self.label, self.tracer, self.smoothTolerance,
+                           self.parallel, self.sliceCache, self.backgroundKey,
+                           progress, self.timer, commit=commit, track=self.tracking)
+      except Exception as e:
+        result = (None, None, "Error: propagation failed: {}".format(e))
+      self.results.put(('done', front) + result)
+
+    TraceAndSelectLogic.running = self
+    for front, offset in enumerate(self.offsets):
+      if offset == 0:
+        self.outcomes[front] = (0, 0, None)
         continue
-      if not (extrema[0] < location[0] < extrema[1] and extrema[2] < location[1] < extrema[3]):
-        # Went out of bounds for path
-        print("@@@WENT OUT OF BOUNDS FOR PATH!")
-        self.setErrorMessage("Error: Went out of bounds for path.")
-        self.undoRedo.undo()
+      worker = threading.Thread(target=run, args=(front,))
+      worker.daemon = True
+      worker.start()
+      self.workers.append(worker)
+    self.pollTimer = qt.QTimer()
+    self.pollTimer.setInterval(POLL_MILLISECONDS)
+    self.pollTimer.connect('timeout()', self.onPropagationTimer)
+    self.pollTimer.start()
+
+  def onPropagationTimer(self):
+    """Write the planes the workers finished since the last call, then wrap up once they are done.
+    An error on the way cancels the workers and still ends the run, see endPropagation.
+    """
+    ended = True
+    try:
+      if self.progress.wasCanceled:
+        self.canceled.set()
+      while True:
+        try:
+          message = self.results.get_nowait()
+        except queue.Empty:
+          break
+        front = message[1]
+        if message[0] == 'plane':
+          if write_plane(self.labelArray, message[2], message[3], self.label, self.delta):
+            self.dirty = True
+          self.slicesDone += 1
+        elif message[0] == 'progress':
+          self.onPropagationProgress(front, message[2])
+        else:
+          filled, visited, error = message[2:]
+          if visited is None:
+            # The worker failed, count the slice it was on as visited
+            visited = self.visited[front]
+          self.outcomes[front] = (filled, visited, error)
+      if None in self.outcomes:
+        self.updateLabelThrottled()
+        ended = False
         return
-      labelDrawArray[location] = label
-      if l != label:
-        # only count those pixels that were changed (to allow step-by-step growing by multiple mouse clicks)
-        pixelsSet += 1
-      if pixelsSet > maxPixels:
-        toVisit = []
+      visited = [outcome[1] for outcome in self.outcomes]
+      # Show the last slice visited, the one that failed if any
+      if self.offsets[0] != 0:
+        self.jumpToSlice(self.direction * visited[0])
       else:
-          # add the 4 neighbors to the stack
-          toVisit.append((location[0] - 1, location[1]     ))
-          toVisit.append((location[0] + 1, location[1]     ))
-          toVisit.append((location[0]    , location[1] - 1 ))
-          toVisit.append((location[0]    , location[1] + 1 ))
-
-    # signal to slicer that the label needs to be updated
-    ## CHANGE OFFSET
-    print("@@@Offset:|%s|" % node.GetParameter("TraceAndSelect,offsetvalue"))
-    
-    self.offset = float(node.GetParameter("TraceAndSelect,offsetvalue"))
-    print("OFFSET SIGN: %s" % math.copysign(1, self.offset) )
-
-    if self.offset != 0:
-      slices_seen = self.progress.maximum - abs(self.offset)
-      if self.progress.wasCanceled:
+        self.jumpToSlice(-self.direction * visited[1])
+      self.offset -= self.direction * visited[0]
+      self.oppositeOffset = abs(self.offsets[1]) - visited[1]
+      errors = [outcome[2] for outcome in self.outcomes if outcome[2] is not None]
+      if self.canceled.is_set():
         self.offset = 0
-        layoutManager = slicer.app.layoutManager()
-        widget = layoutManager.sliceWidget('Red')
-        rednode = widget.sliceLogic().GetSliceNode()
-        rednode.SetSliceOffset(rednode.GetSliceOffset() + math.copysign(1, self.offset))
-        node.SetParameter("TraceAndSelect,offsetvalue",
-                          str(0))
-        self.setErrorMessage("Fill abandoned after {} slice(s)".format(int(slices_seen)),1)
-        return
-      self.progress.setValue(slices_seen)
-      layoutManager = slicer.app.layoutManager()
-      widget = layoutManager.sliceWidget('Red')
-      rednode = widget.sliceLogic().GetSliceNode()
-      rednode.SetSliceOffset(rednode.GetSliceOffset() + math.copysign(1, self.offset))
-      node.SetParameter("TraceAndSelect,offsetvalue", str(self.offset -  math.copysign(1, self.offset)))
-      print(self.offset)
-      
-      ### Calc centoid mean stuff here
-
-      recs_mean = (mean[0]/count, mean[1]/count)
-      rec_mean = get_optional_seeds(best_path, recs_mean)[0]
-      print("MEAN:", rec_mean, recs_mean)
-      rec_ijk = list(original_ijk)
-      for i in range(0,3):
-        rec_ijk[i] = int(rec_ijk[i] + int(math.copysign(1, self.offset)))
-      rec_ijk[ijk_reconstruction_indexes[0]] = rec_mean[0]
-      rec_ijk[ijk_reconstruction_indexes[1]] = rec_mean[1]
-      print("RECURSIVE IJK:", rec_ijk)
-      print("#########RECURSE#########")
-      return self.fill(rec_ijk, optional_seeds=get_optional_seeds(best_path, recs_mean))
-      
-      ###
-    
+        self.oppositeOffset = 0
+        self.setErrorMessage("Fill abandoned after {} slice(s)".format(self.slicesDone), 1)
+      elif errors:
+        self.setErrorMessage("\n".join(errors))
+      else:
+        self.setErrorMessage("Fill complete. No errors detected.", 1)
+      self.finishFill()
+    except Exception:
+      self.canceled.set()
+      raise
+    finally:
+      if ended:
+        self.endPropagation()
+
+  def endPropagation(self):
+    """Stop polling and wait for the workers, then let the next fill start.
+    Pushes the undo checkpoint of the slices written so far and closes the progress dialog,
+    in case the run ended on an error before finishFill got to it.
+    """
+    self.pollTimer.stop()
+    for worker in self.workers:
+      worker.join()
+    TraceAndSelectLogic.running = None
+    self.pushDelta()
+    self.closeProgress()
+
+  def finishFill(self):
+    """Store the offset left to propagate and update the label map once a fill is over."""
+    node = EditUtil.EditUtil().getParameterNode()
+    if self.keepOffset:
+      node.SetParameter("TraceAndSelect,offsetvalue", str(self.offset))
+      node.SetParameter("TraceAndSelect,oppositeOffset", str(self.oppositeOffset))
+    # signal to slicer that the label needs to be updated
+    self.updateLabel()
+    with timed(self.timer, 'undo'):
+      self.pushDelta()
+    self.closeProgress()
+    self.saveTimings()
     print("@@@FILL DONE")
-    EditUtil.EditUtil().markVolumeNodeAsModified(labelNode)
-    self.setErrorMessage("Fill complete. No errors detected.", 1)
 
-    return
+  def closeProgress(self):
+    """Close the progress dialog of the fill, if it is still open."""
+    if self.progress is not None:
+      self.progress.close()
+      self.progress = None
+
+  def saveTimings(self):
+    if self.timer is not None:
+      node = EditUtil.EditUtil().getParameterNode()
+      hits = self.sliceCache.hits - self.cacheCounts[0]
+      misses = self.sliceCache.misses - self.cacheCounts[1]
+      summary = self.timer.summary() + "\nslice cache: %d hits, %d misses" % (hits, misses)
+      node.SetParameter("TraceAndSelect,timings", summary)
+
+  def saveDelta(self):
+    """Return the LabelDelta that records the fill about to be written, see pushDelta.
+    Only the regions that get written are recorded, instead of a snapshot of the volume.
+    The undo stack is left enabled, the modal progress dialog keeps other edits out of the run.
+    Falls back to saveState, returning None, if the undo stack does not keep checkpoints.
+    """
+    undoRedo = self.undoRedo
+    if not hasattr(undoRedo, 'undoList'):
+      undoRedo.saveState()
+      return None
+    if not getattr(undoRedo, 'enabled', True):
+      return None
+    return LabelDelta()
+
+  def pushDelta(self):
+    """Push the undo checkpoint of the fill recorded by saveDelta, once it is over."""
+    if self.delta is None:
+      return
+    undoRedo = self.undoRedo
+    undoRedo.undoList.append(LabelDeltaCheckPoint(undoRedo, self.labelNode, self.delta))
+    undoRedo.redoList = []
+    undoSize = getattr(undoRedo, 'undoSize', 100)
+    if len(undoRedo.undoList) > undoSize:
+      undoRedo.undoList = undoRedo.undoList[-undoSize:]
+    undoRedo.stateChangedCallback()
+    self.delta = None
+
+  def onPropagationProgress(self, front, visited):
+    """Called on the main thread as the worker of front starts on its next slice: follow along if asked to."""
+    self.visited[front] = visited
+    self.progress.setValue(sum(self.visited))
+    if self.follow and front == 0:
+      self.jumpToSlice(self.direction * visited)
+
+  def jumpToSlice(self, offset):
+    """Move the clicked view to the slice offset slices away from the clicked one."""
+    ijk = list(self.startIJK)
+    ijk[PLANE_AXES[self.ijkPlane]] += offset
+    ijkToRAS = vtk.vtkMatrix4x4()
+    self.labelNode.GetIJKToRASMatrix(ijkToRAS)
+    ras = ijkToRAS.MultiplyPoint((ijk[2], ijk[1], ijk[0], 1))
+    self.sliceLogic.GetSliceNode().JumpSliceByOffsetting(ras[0], ras[1], ras[2])
+
+  def updateLabelThrottled(self):
+    """Update the label map once modifiedInterval slices and UPDATE_SECONDS have passed since the last update."""
+    if (self.modifiedInterval > 0 and self.slicesDone - self.updatedSlices >= self.modifiedInterval
+        and time.time() - self.lastUpdate >= UPDATE_SECONDS):
+      self.updatedSlices = self.slicesDone
+      self.updateLabel()
+
+  def updateLabel(self):
+    """Mark the label map as modified if anything was written since the last update."""
+    if not self.dirty:
+      return
+    with timed(self.timer, 'render'):
+      EditUtil.EditUtil().markVolumeNodeAsModified(self.labelNode)
+    # The label was modified through its cached view, which stays valid
+    self.volumeArrays.touch(self.labelNode)
+    self.dirty = False
+    self.lastUpdate = time.time()
   
+  def pathToXY(self, ijk, path):
+    """Return the xy view coordinates of the plane pixels in path, on the slice through ijk."""
+    ijkToXY = self.sliceLogic.GetLabelLayer().GetXYToIJKTransform().GetInverse()
+    indexes = PLANE_INDEXES[self.sliceIJKPlane()]
+    xys = []
+    for pixel in path:
+      index = list(ijk)
+      index[indexes[0]] = pixel[0]
+      index[indexes[1]] = pixel[1]
+      index.reverse()
+      xys.append(ijkToXY.TransformDoublePoint(index)[:2])
+    return xys
+
   def setErrorMessage(self, errorText, errorColor = 0):
     """Call this to seet the message in the error box.
         Parameters: 
@@ -719,247 +1054,82 @@ class TraceAndSelectLogic(LabelEffect.LabelEffectLogic):
     node.SetParameter("TraceAndSelect,errorMessageColor", str(errorColor))
     return
   
-import random
-  
-def get_optional_seeds(seeds, mid, a= 2, b=3):
-  optional_seeds = []
-  maxes = [0,0]
-  mins = [10000, 10000]
-  for i in seeds:
-    maxes[0] = max(i[0], maxes[0])
-    maxes[1] = max(i[1], maxes[1])
-    mins[0] = min(i[0], mins[0])
-    mins[1] = min(i[1], mins[1])
-    
-  optional_seeds.append( (int(mid[0] + a*mins[0])/b, int(mid[1]) ))
-  optional_seeds.append( ( int(mid[0]), int(mid[1] + a*mins[1])/b) )
-  optional_seeds.append( (int(mid[0] + a*maxes[0])/b  ,int(mid[1])) )
-  optional_seeds.append( (int(mid[0]), int(mid[1] + a*mins[1])/b) )
+#
+# VolumeArrays
+#
 
-  return optional_seeds
-  
-  
-def gimme_a_path(location, seed_distance, hi, lo, bgArray, optional_seeds=[]):
-    """Finds the seeds, then builds the paths, then outputs the best path. No messy stuff required."""
-    #
-    # Find edge pixels
-    #
-    seeds = find_edges(location, seed_distance, hi, lo, bgArray)
-    print("BEFORE", seeds)
-    seeds.extend(optional_seeds)
-    print("AFTER", seeds)
-    #
-    # Build paths
-    #
-    print("@@@BUILDING PATH")
-    paths = []
-    for seed in seeds:
-        if seed is None:
-            continue
-        print("--- SEED ---",  str(seed))
-        repeat = False
-        for path in paths:
-            if seed in path:
-                repeat = True
-            break
-        if repeat:
-            continue
-        ret_val = build_path(seed, hi, lo, bgArray)
-        if ret_val[0] == []:
-            continue
-        paths.append(ret_val)
-    
-    #
-    # Find best path
-    #
-    best_path = find_best_path(paths, location)
-    best_path = smooth_path(best_path, hi, lo, bgArray)
-        
-    return best_path
-    
+class VolumeArrays(object):
+  """
+  Numpy views over the scalars of volume nodes, in (k, j, i) order,
+  kept between clicks. A view is only made again when the node, the
+  dimensions of its image or the scalars array or its modified time
+  change. Planes are selected from the views with plane_index, which
+  does not copy either.
+  """
 
-def smooth_path(path_obj, hi, lo, bgArray):
-    """Smooth the path by adding extra pixels to visited."""
-    offsets = [
-        (0, 1),
-        (1, 1),
-        (1, 0),
-        (1, -1),
-        (0, -1),
-        (-1, -1),
-        (-1, 0),
-        (-1, 1)
-    ]
-    num_pixels_added = 0
-    best_path, visited, dead_ends = path_obj
-    for pixel in best_path:
-        for offset in offsets:
-            neighbor = (pixel[0] + offset[0], pixel[1] + offset[1])
-            p_intensity = None
-            n_intensity = None
-            try:
-                p_intensity = fetch_val(bgArray, pixel)
-                n_intensity = fetch_val(bgArray, neighbor)
-            except IndexError:
-                continue
-            if neighbor in visited or lo < n_intensity < hi:
-                continue
-            """
-            distance = abs(bgArray[neighbor] - bgArray[pixel])
-            percentage = float(distance) / (bgArray[pixel] + 3024)  # Add 3024 to scale with negative grayscale vals
-            if percentage <= 0.2:
-                visited.append(neighbor)
-                num_pixels_added += 1
-            """
-            proximity = abs(n_intensity - p_intensity)
-            if bgArray[neighbor] > hi:
-                distance = bgArray[neighbor] - hi
-            else:
-                distance = lo - n_intensity
-            if distance <= 125:
-                visited.append(neighbor)
-                num_pixels_added += 1
-    print("%d pixels were added during smoothing." %num_pixels_added)
-    return (best_path, visited, dead_ends)
-    
-  
-  ###
-  ###
-  ## End HERE ##########
-  ##
-  ###
-  ###
+  def __init__(self):
+    self.views = {}
+
+  def key(self, volumeNode):
+    image = volumeNode.GetImageData()
+    scalars = image.GetPointData().GetScalars()
+    return (volumeNode.GetID(), image.GetDimensions(), scalars.GetMTime())
+
+  def array(self, volumeNode):
+    """Return the numpy view of the scalars of volumeNode."""
+    import vtk.util.numpy_support
+    key = self.key(volumeNode)
+    scalars = volumeNode.GetImageData().GetPointData().GetScalars()
+    view = self.views.get(volumeNode.GetID())
+    if view is not None and view[0] == key and view[1] is scalars:
+      return view[2]
+    shape = list(key[1])
+    shape.reverse()
+    array = vtk.util.numpy_support.vtk_to_numpy(scalars).reshape(shape)
+    self.views[volumeNode.GetID()] = (key, scalars, array)
+    return array
 
-def find_edge(point, offset, max_dist, hi, lo, bgArray):
-    """Return the first edgepoint and its distance from point using offset.
-    None if no path found.
-    """
-    for i in range(1, max_dist):
-        next = (point[0] + i * offset[0], point[1] + i * offset[1])
-        if is_edge(next, hi, lo, bgArray):
-            return (next, i)
-    return None
-
-def find_edges(starting_point, max_dist, hi, lo, bgArray):
-    """Return an array of edge points found growing outward from starting_point.
-    Search does not exceed max_dist.
-    If starting_point is within threshold, find a maximum of 4 points, one for each offset.
-    If starting_point is NOT within threshold, try to find as many as 8 points; two for each offset.
-    """
-    try:
-        b = fetch_val(bgArray, starting_point)
-    except IndexError:
-        return None
-    offsets = [(0,1), (1,0), (0,-1), (-1,0)]
-    edgePoints = []
-    for offset in offsets:
-        first_result = find_edge(starting_point, offset, max_dist, hi, lo, bgArray)
-        if first_result is not None:
-            edgePoints.append(first_result[0])
-            if b < lo or b > hi:
-                # Try to find second point, since starting click was outside threshold
-                second_result = find_edge(first_result[0], offset, max_dist - first_result[1], hi, lo, bgArray)
-                if second_result is not None:
-                    edgePoints.append(second_result[0])
-    return edgePoints
-
-def build_path(start, hi, lo, bgArray):
-    """Return a complete path from start."""
-    dead_ends = 0
-    offsets = [
-        (0, 1),
-        (1, 1),
-        (1, 0),
-        (1, -1),
-        (0, -1),
-        (-1, -1),
-        (-1, 0),
-        (-1, 1)
-    ]
-    visited = [start,]
-    path = [start,]
-    location = start
-    while path != []:
-        found = False
-        for offset in offsets:
-            neighbor = (location[0] + offset[0], location[1] + offset[1])
-            if len(visited) > 1 and neighbor == start:
-                # lArray[neighbor] = label
-                # print("Dead ends: ", dead_ends)
-                return (path, visited, dead_ends)
-            if is_edge(neighbor, hi, lo, bgArray) and neighbor not in visited:
-                # lArray[neighbor] = label
-                visited.append(neighbor)
-                path.append(neighbor)
-                location = neighbor
-                found = True
-                break
-        if not found:
-            # Dead end found, re-trace steps
-            # print("@@@DEAD END!")
-            dead_ends += 1
-            path.pop()
-            if len(path) > 0:
-                location = path[len(path)-1]
-    print("@@@Edge is not part of the path? What the?")
-    return ([],[], -1)
-
-def find_best_path(paths, ijk):
-    """Returns the best path from a list of paths ([points], [visited], dead_ends)"""
-    best_path = ([],[],-1)
-    best_area = 0
-    for path in paths:
-        extrema = get_extrema(path[0])
-        # Check if ijk is likely contained within the path
-        if extrema[0] < ijk[0] < extrema[1] and extrema[2] < ijk[1] < extrema[3]:
-            # Create an over estimate of the approximate area of the path
-            area = (extrema[1]-extrema[0])*(extrema[3]-extrema[2])
-            if area > best_area:
-                best_path = path
-                best_area = area
-    return best_path
-        
-
-def get_extrema(list):
-    """Returns the max and min x and y values from a list of coordinate tuples in the form of (min_x, max_x, min_y, max_y)."""
-    max_x = max(list,key=lambda item:item[0])[0]
-    max_y = max(list,key=lambda item:item[1])[1]
-    min_x = min(list,key=lambda item:item[0])[0]
-    min_y = min(list,key=lambda item:item[1])[1]
-    return (min_x, max_x, min_y, max_y)
-
-def is_edge(location, hi, lo, bgArray):
-    """Return true is location is an edge pixel."""
-    offsets = [
-        (0,1),
-        (1,0),
-        (0,-1),
-        (-1,0)
-    ]
-    # Check that location is within threshold first
-    try:
-        b = fetch_val(bgArray, location)
-    except IndexError:
-        return False
-    if b < lo or b > hi:
-        return False
-    
-    # Check if its neighbors are outside the threshold
-    for offset in offsets:
-        tmp = (location[0] + offset[0], location[1] + offset[1])
-        try:
-            b = fetch_val(bgArray, tmp)
-        except IndexError:
-            return True
-        if b < lo or b > hi:
-            return True
-    return False
-
-def fetch_val(array, coordinate):
-    if coordinate[0] < 0 or coordinate[1] < 0:
-        raise IndexError
-    return array[coordinate]
+  def touch(self, volumeNode):
+    """Keep the view of volumeNode valid after marking it modified for writes done through it."""
+    view = self.views.get(volumeNode.GetID())
+    if view is not None and view[1] is volumeNode.GetImageData().GetPointData().GetScalars():
+      self.views[volumeNode.GetID()] = (self.key(volumeNode),) + view[1:]
 
+#
+# LabelDeltaCheckPoint
+#
+
+class LabelDeltaCheckPoint(object):
+  """
+  Undo checkpoint of a fill, kept on the editor undo and redo lists
+  next to the volume checkpoints of UndoRedo. Restoring it swaps the
+  regions recorded by its LabelDelta back into the label volume.
+  """
+
+  def __init__(self, undoRedo, volumeNode, delta):
+    self.undoRedo = undoRedo
+    # the node to which the delta will be restored
+    self.volumeNode = volumeNode
+    self.delta = delta
+    self.undone = False
+
+  def restore(self):
+    import vtk.util.numpy_support
+    image = self.volumeNode.GetImageData()
+    shape = list(image.GetDimensions())
+    shape.reverse()
+    labelArray = vtk.util.numpy_support.vtk_to_numpy(image.GetPointData().GetScalars()).reshape(shape)
+    self.delta.swap(labelArray)
+    # UndoRedo stored a snapshot of the volume on the other list before restoring;
+    # this checkpoint now holds the values to swap back, so it takes that place
+    if self.undone:
+      otherList = self.undoRedo.undoList
+    else:
+      otherList = self.undoRedo.redoList
+    if otherList and otherList[-1].volumeNode == self.volumeNode:
+      otherList[-1] = self
+    self.undone = not self.undone
+    EditUtil.EditUtil().markVolumeNodeAsModified(self.volumeNode)
 
 #
 # The TraceAndSelect class definition
@@ -0,0 +1,2 @@
+"""Slicer-independent core of the TraceAndSelect effect, see core."""
+from .core import *
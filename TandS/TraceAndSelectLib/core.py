@@ -0,0 +1,1226 @@
+"""Slicer-independent tracing and filling core of the TraceAndSelect effect.
+Everything here works on numpy arrays and only needs numpy, so it can run in batch
+jobs and worker processes without starting Slicer.
+"""
+import os
+import sys
+import numpy
+import time
+import collections
+import threading
+import multiprocessing
+try:
+  from multiprocessing import shared_memory
+except ImportError:
+  # Python < 3.8, parallel propagation is not available
+  shared_memory = None
+
+# Exported by the package: what the effect and batch jobs use, see the README.
+# The tests reach everything else through TraceAndSelectLib.core.
+__all__ = ['PLANE_AXES', 'PLANE_INDEXES', 'SMOOTH_TOLERANCE', 'TRACERS', 'TRACER_NAMES',
+           'LabelDelta', 'SliceCache', 'StageTimer', 'timed',
+           'segment', 'segment_plane', 'propagate', 'propagation_offset', 'parallel_available', 'worker_pool',
+           'plane_index', 'plane_point', 'box_index', 'write_plane']
+
+# Numpy axis of the volume array that each slice orientation walks along
+PLANE_AXES = {'JK': 2, 'IK': 1, 'IJ': 0}
+# Numpy axes of the volume array that span each slice orientation
+PLANE_INDEXES = {'JK': (0, 1), 'IK': (0, 2), 'IJ': (1, 2)}
+# Offsets shorter than this are not worth starting a process pool for
+PARALLEL_MIN_SLICES = 16
+# Minimum number of slices traced by one worker
+PARALLEL_MIN_CHUNK = 4
+# Dice overlap above which two adjacent slices are considered to agree
+PARALLEL_AGREEMENT = 0.7
+# Dice overlap above which a re-traced slice matches its speculative result
+PARALLEL_MATCH = 0.95
+# Seconds between two looks at the slices finished by the workers
+PARALLEL_POLL_SECONDS = 0.005
+# Amount the lower threshold drops between two levels of the threshold sweep
+SWEEP_STEP = 25
+# Number of lower thresholds tried by the sweep, starting with lo itself
+SWEEP_LEVELS = 3
+# No new sweep level is started after this many seconds
+SWEEP_SECONDS = 5.0
+# Paths with more dead ends than this make the sweep try the next level
+SWEEP_MAX_DEAD_ENDS = 150
+# Default distance from the threshold within which smoothing adds pixels next to the outline
+SMOOTH_TOLERANCE = 125
+# Distance from the contour of the previous plane within which contour tracking looks for edges
+TRACK_BAND = 4
+# A tracked contour whose area changed by more than this factor is retraced from scratch
+TRACK_AREA_RATIO = 1.5
+# Contour tracing engines: depth-first search with backtracking, or Moore-neighbour tracing
+TRACERS = ('dfs', 'moore')
+TRACER_NAMES = {'dfs': 'Depth-first', 'moore': 'Moore neighbour'}
+# 8-neighbour offsets in circular order, as walked by the tracers and smoothing
+NEIGHBOR_OFFSETS = [(0, 1), (1, 1), (1, 0), (1, -1), (0, -1), (-1, -1), (-1, 0), (-1, 1)]
+# After stepping along NEIGHBOR_OFFSETS[d], the pixel scanned just before lies along
+# NEIGHBOR_OFFSETS[MOORE_BACKTRACK[d]] from the new location
+MOORE_BACKTRACK = [NEIGHBOR_OFFSETS.index((NEIGHBOR_OFFSETS[d - 1][0] - NEIGHBOR_OFFSETS[d][0],
+                                           NEIGHBOR_OFFSETS[d - 1][1] - NEIGHBOR_OFFSETS[d][1]))
+                   for d in range(8)]
+
+# Messages of the failures that stop a fill
+ERROR_NO_PATH = "Error: could not find any suitable path."
+ERROR_LEAKED = "Error: Went out of bounds for path."
+ERROR_OPEN_PATH = "Error: the traced outline is not closed."
+ERROR_TOO_MANY_PIXELS = "Error: the fill would set more than {} pixels."
+ERROR_NOTHING_FILLED = "Error: nothing was filled to propagate from."
+ERROR_PROPAGATION = "Error: could not propagate past slice {}."
+
+def segment(backgroundArray, ijk, plane, hi, lo, maxPixels, offset=0, labelArray=None, label=1, tracer='dfs',
+            tolerance=SMOOTH_TOLERANCE, parallel=False, cache=None, cacheKey=(), timer=None, track=False):
+  """Segment the structure around the numpy index ijk of a background volume.
+  The plane through ijk ('IJ', 'IK' or 'JK', named after the slice orientations of the
+  effect) is traced and filled, then the fill is propagated over offset planes, see
+  propagate. Filled pixels are set to label in labelArray, a new int16 volume of zeros
+  if not given. Returns (labelArray, filled, error) with the number of planes written
+  and the message of the failure that stopped the run, or None.
+  timer is an optional StageTimer that the stages of the run are added to, and track
+  follows the contour from plane to plane while propagating, see track_plane.
+  """
+  if labelArray is None:
+    labelArray = numpy.zeros(backgroundArray.shape, dtype=numpy.int16)
+  axis = PLANE_AXES[plane]
+  planeIndex = plane_index(axis, ijk[axis])
+  result, error = segment_plane(backgroundArray[planeIndex], labelArray[planeIndex], plane_point(ijk, plane),
+                                hi, lo, maxPixels, label, [], 1, tracer, tolerance,
+                                cache, cacheKey + (plane, ijk[axis]), timer)
+  if error is not None:
+    return (labelArray, 0, error)
+  mask, window, best_path, mean, count, sweep_lo = result
+  labelArray[box_index(planeIndex, window)][mask] = label
+  if offset == 0:
+    return (labelArray, 1, None)
+  filled, visited, error = propagate(backgroundArray, labelArray, ijk, plane, offset, best_path, mean, count,
+                                     hi, lo, maxPixels, label, tracer, tolerance, parallel, cache, cacheKey,
+                                     timer=timer, track=track)
+  return (labelArray, 1 + filled, error)
+
+def segment_plane(bgArray, labelArray, point, hi, lo, maxPixels, label=1, optional_seeds=[], paintOver=1,
+                  tracer='dfs', tolerance=SMOOTH_TOLERANCE, cache=None, sliceKey=(), timer=None):
+  """Trace the outline around point on one plane and fill its inside, without writing to labelArray.
+  labelArray is the label plane, only pixels that would change count towards maxPixels.
+  Returns (result, error). result is (mask, window, best_path, mean, count, lo) where mask holds
+  every pixel to label on window, the index tuple of a box of the plane, (mean, count) is the
+  running centroid of the filled region and lo the lower threshold the sweep settled on.
+  On failure result is None and error the message.
+  timer is an optional StageTimer, see StageTimer.
+  """
+  if not in_bounds(bgArray, point):
+    return (None, ERROR_NO_PATH)
+  best_path, visited, dead_ends, lo = trace_slice(point, hi, lo, bgArray, optional_seeds, cache, sliceKey,
+                                                  tracer, tolerance, timer)
+  if dead_ends < 0:
+    return (None, ERROR_NO_PATH)
+  return fill_outline(point, best_path, visited, labelArray, label, maxPixels, paintOver, lo, timer)
+
+def track_plane(bgArray, labelArray, prior, point, hi, lo, maxPixels, label=1, paintOver=1, tracer='dfs',
+                tolerance=SMOOTH_TOLERANCE, band=TRACK_BAND, timer=None):
+  """Trace and fill the outline around point like segment_plane, following prior, the best
+  path of the adjacent plane. Edges are only looked for within band pixels of prior, on the
+  box around it, so the tracer only walks the band instead of every contour of the plane.
+  Returns the result of segment_plane, or None if the contour was lost: no closed path
+  around point was found in the band, its area changed by more than TRACK_AREA_RATIO, or
+  the fill was rejected. The caller then traces the plane from scratch with segment_plane.
+  """
+  if not len(prior) or not in_bounds(bgArray, point):
+    return None
+  with timed(timer, 'edges'):
+    window, masks, near = band_masks(bgArray, prior, hi, lo, tolerance, band)
+  top, left = window[0].start, window[1].start
+  local = (point[0] - top, point[1] - left)
+  if not in_bounds(masks[0], local):
+    return None
+  best_path, visited, dead_ends = gimme_a_path(local, 200, hi, lo, bgArray[window], [], masks, tracer=tracer,
+                                               tolerance=tolerance, timer=timer, near=near)
+  if not 0 <= dead_ends <= SWEEP_MAX_DEAD_ENDS:
+    return None
+  best_path = [(row + top, col + left) for row, col in best_path]
+  visited = numpy.asarray(visited) + (top, left)
+  area = path_shape(best_path)[1]
+  priorArea = path_shape(prior)[1]
+  if not priorArea / TRACK_AREA_RATIO <= area <= priorArea * TRACK_AREA_RATIO:
+    return None
+  result, error = fill_outline(point, best_path, visited, labelArray, label, maxPixels, paintOver, lo, timer)
+  return result
+
+def fill_outline(point, best_path, visited, labelArray, label, maxPixels, paintOver, lo, timer=None):
+  """Fill the inside of a traced outline from point, returning (result, error) as segment_plane does.
+  The fill is rejected before anything is written if the outline is not closed, if it leaks out
+  of the outline or if it would set more than maxPixels pixels.
+  Only the box around visited and point is filled, a fill that gets out of it leaks anyway;
+  the mask of the result covers that box.
+  """
+  if not path_closed(best_path):
+    return (None, ERROR_OPEN_PATH)
+  with timed(timer, 'fill'):
+    visited = numpy.asarray(visited).reshape(-1, 2)
+    top = min(int(visited[:, 0].min()), point[0])
+    left = min(int(visited[:, 1].min()), point[1])
+    window = (slice(top, max(int(visited[:, 0].max()), point[0]) + 1),
+              slice(left, max(int(visited[:, 1].max()), point[1]) + 1))
+    outline = path_mask(visited - (top, left), (window[0].stop - top, window[1].stop - left))
+    region, pixelsSet, leaked = fill_path((point[0] - top, point[1] - left),
+                                          [(row - top, col - left) for row, col in best_path],
+                                          labelArray[window], label, maxPixels, paintOver, outline)
+  if leaked:
+    return (None, ERROR_LEAKED)
+  if pixelsSet > maxPixels:
+    return (None, ERROR_TOO_MANY_PIXELS.format(int(maxPixels)))
+  mean, count = region_centroid(region)
+  mean = (mean[0] + top * count, mean[1] + left * count)
+  outline |= region
+  return ((outline, window, best_path, mean, count, lo), None)
+
+def plane_point(ijk, plane):
+  """Return the in-plane coordinates of the numpy index ijk."""
+  indexes = PLANE_INDEXES[plane]
+  return (ijk[indexes[0]], ijk[indexes[1]])
+
+def propagation_offset(shape, ijk, plane, offset):
+  """Return offset clipped so that propagating from ijk stays inside a volume of the given shape."""
+  axis = PLANE_AXES[plane]
+  if offset > 0:
+    return min(offset, shape[axis] - 1 - ijk[axis])
+  return max(offset, -ijk[axis])
+
+def propagate(backgroundArray, labelArray, ijk, plane, offset, best_path, mean, count, hi, lo, maxPixels, label=1,
+              tracer='dfs', tolerance=SMOOTH_TOLERANCE, parallel=False, cache=None, cacheKey=(), progress=None,
+              timer=None, delta=None, commit=None, track=False):
+  """Propagate the fill of the plane through the numpy index ijk over the next abs(offset)
+  planes, in the direction of the sign of offset. (best_path, mean, count) is the result of
+  that plane. Each plane is seeded from the one before and written to labelArray once filled;
+  long runs go to propagate_parallel when parallel is set. progress is called with the number
+  of planes visited before each plane is traced and cancels the run by returning true.
+  Returns (filled, visited, error): the planes written, the planes visited including one that
+  failed, and the message of the failure that stopped the run, or None.
+  timer is an optional StageTimer; planes traced on a process pool are not timed.
+  delta is an optional LabelDelta that records the previous values of every plane written.
+  commit, if given, is called with (planeIndex, mask) of every filled plane instead of
+  writing it, so that the caller can write labelArray from another thread; planeIndex
+  may select only the box of the plane that mask covers, see write_plane.
+  track follows the contour of each plane into the next with track_plane, tracing the
+  plane from scratch only when the contour is lost.
+  """
+  offset = int(propagation_offset(backgroundArray.shape, ijk, plane, offset))
+  if offset == 0:
+    return (0, 0, None)
+  if parallel and parallel_available() and abs(offset) >= PARALLEL_MIN_SLICES:
+    return propagate_parallel(backgroundArray, labelArray, ijk, plane, offset, best_path, mean, count,
+                              hi, lo, maxPixels, label, tracer, tolerance, progress, delta, commit, track)
+  direction = 1 if offset > 0 else -1
+  axis = PLANE_AXES[plane]
+  indexes = PLANE_INDEXES[plane]
+  filled = 0
+  while filled < abs(offset):
+    if progress is not None and progress(filled + 1):
+      break
+    if count == 0:
+      return (filled, filled, ERROR_NOTHING_FILLED)
+    point, optional_seeds = next_seeds(best_path, mean, count)
+    ijk = list(ijk)
+    ijk[axis] += direction
+    ijk[indexes[0]], ijk[indexes[1]] = point
+    planeIndex = plane_index(axis, ijk[axis])
+    result = None
+    if track:
+      result = track_plane(backgroundArray[planeIndex], labelArray[planeIndex], best_path, point, hi, lo, maxPixels,
+                           label, 1, tracer, tolerance, timer=timer)
+    if result is None:
+      result, error = segment_plane(backgroundArray[planeIndex], labelArray[planeIndex], point, hi, lo, maxPixels,
+                                    label, optional_seeds, 1, tracer, tolerance,
+                                    cache, cacheKey + (plane, ijk[axis]), timer)
+      if error is not None:
+        return (filled, filled + 1, error)
+    mask, window, best_path, mean, count, sweep_lo = result
+    if commit is not None:
+      commit(box_index(planeIndex, window), mask)
+    else:
+      write_plane(labelArray, box_index(planeIndex, window), mask, label, delta)
+    filled += 1
+  return (filled, filled, None)
+
+def propagate_parallel(backgroundArray, labelArray, ijk, plane, offset, best_path, mean, count, hi, lo, maxPixels,
+                       label=1, tracer='dfs', tolerance=SMOOTH_TOLERANCE, progress=None, delta=None, commit=None,
+                       track=False, workers=None):
+  """Propagate like propagate does, tracing the planes on the worker pool.
+  The planes are split into chunks that are traced concurrently, one per worker but no
+  shorter than PARALLEL_MIN_CHUNK; workers is the number of CPUs if not given. Every chunk but the
+  first is seeded speculatively from the filled plane, so a chunk whose first plane
+  disagrees with the plane before it is re-traced here until it agrees again.
+  The planes are shared with the workers through shared memory, next to a status array
+  where the workers flag every plane they finish. Planes are committed in order as soon
+  as they are finished and checked, and canceling stops every worker before its next
+  plane. progress may be called again with the same count while waiting for a plane.
+  """
+  direction = 1 if offset > 0 else -1
+  axis = PLANE_AXES[plane]
+  indexes = [ijk[axis] + direction * m for m in range(1, abs(offset) + 1)]
+  planes = [plane_index(axis, index) for index in indexes]
+  shape = (len(planes),) + backgroundArray[planes[0]].shape
+
+  # Copy the planes of the run into shared memory, stacked along the first axis, next to
+  # an output block where the workers mark the pixels to label and the status array:
+  # status[m] is 1 once plane m is filled and -1 if it was not, status[-1] cancels the run
+  blocks = []
+  views = []
+  pending = []
+  status = None
+  try:
+    shared = []
+    for source, dtype, blockShape in ((backgroundArray, backgroundArray.dtype, shape),
+                                      (labelArray, labelArray.dtype, shape),
+                                      (None, numpy.dtype(numpy.uint8), shape),
+                                      (None, numpy.dtype(numpy.int8), (len(planes) + 1,))):
+      block = shared_memory.SharedMemory(create=True, size=int(numpy.prod(blockShape)) * dtype.itemsize)
+      blocks.append(block)
+      view = numpy.ndarray(blockShape, dtype=dtype, buffer=block.buf)
+      if source is not None:
+        for m, planeIndex in enumerate(planes):
+          view[m] = source[planeIndex]
+      else:
+        view[...] = 0
+      views.append(view)
+      shared.append((block.name, blockShape, dtype.str))
+    backgroundPlanes, labelPlanes, out, status = views
+
+    # The first chunk continues from the filled plane, the others start from its projection
+    point, optional_seeds = next_seeds(best_path, mean, count)
+    if workers is None:
+      workers = multiprocessing.cpu_count()
+    chunkSize = max(PARALLEL_MIN_CHUNK, -(-len(indexes) // workers))
+    starts = list(range(0, len(indexes), chunkSize))
+    pool = worker_pool()
+    pending = [pool.apply_async(propagate_chunk, ((shared, (start, min(start + chunkSize, len(indexes))), point,
+                                                  optional_seeds, hi, lo, label, maxPixels, tracer, tolerance,
+                                                  track),))
+               for start in starts]
+
+    # (best_path, mean, count) of the planes re-traced here, the others are in the chunk results
+    results = [None] * len(planes)
+
+    def previous_result(m):
+      if m == 0:
+        return (best_path, mean, count)
+      if results[m - 1] is None:
+        return pending[(m - 1) // chunkSize].get()[(m - 1) % chunkSize]
+      return results[m - 1]
+
+    retracing = False
+    filled = 0
+    for m in range(len(planes)):
+      if progress is not None and progress(m + 1):
+        return (filled, filled, None)
+      chunk = m // chunkSize
+      while status[m] == 0 and not pending[chunk].ready():
+        time.sleep(PARALLEL_POLL_SECONDS)
+        if progress is not None and progress(m + 1):
+          return (filled, filled, None)
+      if status[m] == 0:
+        # The worker returned without finishing the plane, raise its error
+        pending[chunk].get()
+      finished = status[m] > 0
+      if m > 0 and m == starts[chunk]:
+        # Consistency check of a speculative chunk against the plane before it
+        retracing = not finished or not planes_agree(out[m - 1], out[m])
+      if retracing or not finished:
+        previous = previous_result(m)
+        if previous[2] == 0:
+          return (filled, filled, ERROR_NOTHING_FILLED)
+      if retracing:
+        speculative = out[m].copy() if finished else None
+        point, optional_seeds = next_seeds(*previous)
+        results[m] = fill_plane(point, optional_seeds, hi, lo, backgroundPlanes[m], labelPlanes[m], label,
+                                maxPixels, out[m], tracer=tracer, tolerance=tolerance,
+                                prior=previous[0] if track else None)
+        if results[m] is None:
+          return (filled, filled + 1, ERROR_PROPAGATION.format(filled + 1))
+        # The worker's planes are good again from the first re-traced plane that matches its own
+        retracing = speculative is None or not planes_agree(speculative, out[m], PARALLEL_MATCH)
+      elif not finished:
+        return (filled, filled + 1, ERROR_PROPAGATION.format(filled + 1))
+      if commit is not None:
+        commit(planes[m], out[m] > 0)
+      else:
+        write_plane(labelArray, planes[m], out[m] > 0, label, delta)
+      filled += 1
+    return (filled, filled, None)
+  finally:
+    # Stop the workers still running, and wait for them before unmapping the shared memory
+    if status is not None:
+      status[-1] = 1
+    for result in pending:
+      result.wait()
+    # Release the views before unmapping the shared memory under them
+    backgroundPlanes = labelPlanes = out = status = view = None
+    del views[:]
+    for block in blocks:
+      block.close()
+      block.unlink()
+
+def write_plane(labelArray, planeIndex, mask, label, delta=None):
+  """Set the pixels of mask to label on the plane planeIndex of labelArray.
+  planeIndex may also select a box of the plane, from box_index, that mask covers.
+  The bounding box of mask is recorded with its previous values in the LabelDelta delta, if given.
+  Returns true if mask had any pixel to write.
+  """
+  region = mask_region(planeIndex, mask)
+  if region is None:
+    return False
+  if delta is not None:
+    delta.record(labelArray, region)
+  labelArray[planeIndex][mask] = label
+  return True
+
+def mask_region(planeIndex, mask):
+  """Return the index tuple of the bounding box of mask on the plane, or box of a plane, planeIndex,
+  or None if mask is empty.
+  """
+  rows = numpy.flatnonzero(mask.any(axis=1))
+  if rows.size == 0:
+    return None
+  cols = numpy.flatnonzero(mask.any(axis=0))
+  region = list(planeIndex)
+  inPlane = [axis for axis in range(len(region)) if isinstance(region[axis], slice)]
+  top, left = region[inPlane[0]].start or 0, region[inPlane[1]].start or 0
+  region[inPlane[0]] = slice(top + int(rows[0]), top + int(rows[-1]) + 1)
+  region[inPlane[1]] = slice(left + int(cols[0]), left + int(cols[-1]) + 1)
+  return tuple(region)
+
+def plane_index(axis, index):
+  """Return the index tuple that selects plane index along axis of a volume array."""
+  planeIndex = [slice(None)] * 3
+  planeIndex[axis] = index
+  return tuple(planeIndex)
+
+def box_index(planeIndex, window):
+  """Return the index tuple that selects the box window, a pair of slices, of the plane planeIndex."""
+  box = list(planeIndex)
+  inPlane = [axis for axis in range(len(box)) if isinstance(box[axis], slice)]
+  box[inPlane[0]], box[inPlane[1]] = window
+  return tuple(box)
+
+# Names of the Python launcher that Slicer installs next to its application binary
+SLICER_PYTHON = ('PythonSlicer', 'PythonSlicer.exe')
+
+def parallel_available():
+  """Return true if slices can be traced on a process pool with shared memory, on more than one core,
+  by workers started with a Python interpreter, see worker_executable.
+  """
+  return shared_memory is not None and multiprocessing.cpu_count() > 1 and worker_executable() is not None
+
+def worker_executable():
+  """Return the Python interpreter that the worker processes are started with, or None if there is none.
+  Inside Slicer sys.executable is the Slicer application, which must not be started once per
+  worker; Slicer's own PythonSlicer launcher runs them with the same Python environment.
+  """
+  if os.path.basename(sys.executable).lower().startswith('python'):
+    return sys.executable
+  # PythonSlicer is next to the application binary, or in the bin folder next to the launcher
+  folder = os.path.dirname(sys.executable)
+  for candidate in (folder, os.path.join(folder, 'bin'), os.path.join(folder, '..', 'bin')):
+    for name in SLICER_PYTHON:
+      path = os.path.join(candidate, name)
+      if os.path.isfile(path):
+        return os.path.normpath(path)
+  return None
+
+# Process pool shared by every parallel trace, see worker_pool
+sharedPool = None
+sharedPoolLock = threading.Lock()
+
+def worker_pool():
+  """Return the process pool that parallel propagation traces slices on, started on first use.
+  Its workers are started with the forkserver or spawn method rather than forked from
+  the calling process, which may be running GUI and worker threads, and run
+  worker_executable rather than sys.executable. The pool is shared
+  by every caller and kept for the life of the process, so only the first call pays for
+  starting it.
+  """
+  global sharedPool
+  with sharedPoolLock:
+    if sharedPool is None:
+      methods = multiprocessing.get_all_start_methods()
+      context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+      context.set_executable(worker_executable())
+      sharedPool = context.Pool(multiprocessing.cpu_count())
+    return sharedPool
+
+def planes_agree(previous, current, agreement=PARALLEL_AGREEMENT):
+  """Return true if the filled masks of two planes overlap by at least agreement (Dice)."""
+  previous = previous > 0
+  current = current > 0
+  total = previous.sum() + current.sum()
+  if total == 0:
+    return False
+  return 2.0 * (previous & current).sum() / total >= agreement
+
+def propagate_chunk(job):
+  """Process pool worker: trace and fill a consecutive chunk of planes in shared memory.
+  Flags every plane in the status array as it is finished, see propagate_parallel, and
+  stops at the first plane that fails or once the run is canceled.
+  Returns the (best_path, mean, count) of every plane filled.
+  """
+  shared, chunk, point, optional_seeds, hi, lo, label, maxPixels, tracer, tolerance, track = job
+  blocks = [shared_memory.SharedMemory(name=name) for name, shape, dtype in shared]
+  backgroundPlanes = labelPlanes = out = status = None
+  try:
+    backgroundPlanes, labelPlanes, out, status = [numpy.ndarray(shape, dtype=numpy.dtype(dtype), buffer=block.buf)
+                                                  for block, (name, shape, dtype) in zip(blocks, shared)]
+    results = []
+    prior = None
+    for m in range(chunk[0], chunk[1]):
+      if status[-1]:
+        break
+      result = fill_plane(point, optional_seeds, hi, lo, backgroundPlanes[m], labelPlanes[m], label, maxPixels, out[m],
+                          tracer=tracer, tolerance=tolerance, prior=prior)
+      if result is None:
+        break
+      results.append(result)
+      status[m] = 1
+      if result[2] == 0:
+        # Nothing to seed the next plane from
+        break
+      point, optional_seeds = next_seeds(*result)
+      if track:
+        prior = result[0]
+    # The planes of the chunk that will not be filled
+    status[chunk[0] + len(results):chunk[1]] = -1
+    return results
+  finally:
+    # Release the views before unmapping the shared memory under them
+    backgroundPlanes = labelPlanes = out = status = None
+    for block in blocks:
+      block.close()
+
+class StageTimer(object):
+  """Wall time spent in each stage of a fill, in the order the stages first ran.
+  Stages are timed with timed(timer, name); a stage that runs several times adds up.
+  The propagation threads share the timer, so adding and reading it are locked.
+  """
+
+  def __init__(self):
+    self.seconds = collections.OrderedDict()
+    self.calls = {}
+    self.lock = threading.Lock()
+
+  def add(self, name, seconds):
+    with self.lock:
+      self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+      self.calls[name] = self.calls.get(name, 0) + 1
+
+  def summary(self):
+    """Return one 'name: milliseconds' line per stage, with the call count of repeated stages."""
+    lines = []
+    with self.lock:
+      for name, seconds in self.seconds.items():
+        line = "%s: %.1f ms" % (name, 1000 * seconds)
+        if self.calls[name] > 1:
+          line += " (%d calls)" % self.calls[name]
+        lines.append(line)
+    return "\n".join(lines)
+
+class TimedStage(object):
+  """Context manager adding the time spent in its block to a stage of a StageTimer."""
+
+  def __init__(self, timer, name):
+    self.timer = timer
+    self.name = name
+
+  def __enter__(self):
+    self.start = time.time()
+
+  def __exit__(self, *exc):
+    self.timer.add(self.name, time.time() - self.start)
+
+class UntimedStage(object):
+  """Context manager that does nothing, used while timing is off."""
+
+  def __enter__(self):
+    pass
+
+  def __exit__(self, *exc):
+    pass
+
+UNTIMED = UntimedStage()
+
+def timed(timer, name):
+  """Return a context manager timing its block as stage name of timer, or a no-op if timer is None."""
+  if timer is None:
+    return UNTIMED
+  return TimedStage(timer, name)
+
+class SliceCache(object):
+  """Bounded LRU cache of per-slice tracing artifacts: masks, seeds and traced paths.
+  Keys start with (background node ID, MTime, ijk plane, slice index, ...). Entries of
+  a volume are dropped by validate() once its MTime changes, and the least recently
+  used entries are evicted when the estimated memory use goes over maxBytes.
+  The cache can be shared by threads propagating concurrently.
+  """
+
+  def __init__(self, maxBytes=256 * 1024 * 1024):
+    self.lock = threading.RLock()
+    self.maxBytes = maxBytes
+    self.entries = collections.OrderedDict()
+    self.sizes = {}
+    self.bytes = 0
+    self.mtimes = {}
+    self.hits = 0
+    self.misses = 0
+
+  def validate(self, nodeID, mtime):
+    """Drop the entries of nodeID if they were cached at another MTime."""
+    with self.lock:
+      if self.mtimes.get(nodeID, mtime) != mtime:
+        for key in [key for key in self.entries if key[0] == nodeID]:
+          self.remove(key)
+      self.mtimes[nodeID] = mtime
+
+  def get(self, key):
+    """Return the entry for key, or None on a miss."""
+    with self.lock:
+      if key not in self.entries:
+        self.misses += 1
+        return None
+      # Move the entry to the most recently used end
+      value = self.entries.pop(key)
+      self.entries[key] = value
+      self.hits += 1
+      return value
+
+  def put(self, key, value):
+    size = artifact_size(value)
+    with self.lock:
+      if key in self.entries:
+        self.remove(key)
+      if size > self.maxBytes:
+        return
+      self.entries[key] = value
+      self.sizes[key] = size
+      self.bytes += size
+      while self.bytes > self.maxBytes:
+        self.remove(next(iter(self.entries)))
+
+  def remove(self, key):
+    with self.lock:
+      del self.entries[key]
+      self.bytes -= self.sizes.pop(key)
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+      self.sizes.clear()
+      self.bytes = 0
+
+class LabelDelta(object):
+  """Previous label values of the regions written by a fill, for undo without volume snapshots.
+  Each written plane adds the bounding box of its mask with the values it held before.
+  swap() exchanges those values with the current ones, so calling it again redoes the fill.
+  """
+
+  def __init__(self):
+    self.regions = []
+
+  def record(self, labelArray, region):
+    """Store the values of region, an index tuple from mask_region, of labelArray."""
+    self.regions.append((region, labelArray[region].copy()))
+
+  def swap(self, labelArray):
+    """Exchange the stored values with those in labelArray, latest region first."""
+    for region, values in reversed(self.regions):
+      current = labelArray[region].copy()
+      labelArray[region] = values
+      values[...] = current
+    # The next swap has to replay the regions in the order they were written
+    self.regions.reverse()
+
+def artifact_size(value):
+  """Return a rough estimate of the memory used by a cached artifact, in bytes."""
+  if isinstance(value, numpy.ndarray):
+    return value.nbytes
+  if isinstance(value, PathIndex):
+    return value.owner.nbytes + sum(artifact_size(path) + shape[2].nbytes
+                                    for path, shape in zip(value.paths, value.shapes))
+  if isinstance(value, tuple):
+    return sum(artifact_size(item) for item in value)
+  if isinstance(value, list):
+    # Lists hold coordinate tuples
+    return 64 * (len(value) + 1)
+  return 64
+
+def cached(cache, key, compute=None, *args):
+  """Return the cache entry for key, calling compute(*args) and storing the result on a miss.
+  Without compute, only looks the key up. cache may be None to always compute.
+  """
+  if cache is None:
+    return compute(*args) if compute is not None else None
+  value = cache.get(key)
+  if value is None and compute is not None:
+    value = compute(*args)
+    if value is not None:
+      cache.put(key, value)
+  return value
+
+class PathIndex(object):
+  """Pixel ownership index of the contours traced on one plane at one threshold.
+  owner maps each pixel to the id of the contour through it: 0 if no contour was traced
+  through it yet, -1 if tracing from it failed, otherwise the 1-based index into paths.
+  shapes holds the path_shape of each path.
+  """
+
+  def __init__(self, shape):
+    self.owner = numpy.zeros(shape, dtype=numpy.int32)
+    self.paths = []
+    self.shapes = []
+
+  def add(self, seed, path):
+    """Record the (points, visited, dead_ends) path traced from seed and return its id."""
+    if path[0] == []:
+      self.owner[seed] = -1
+      return -1
+    self.paths.append(path)
+    self.shapes.append(path_shape(path[0]))
+    points = numpy.array(path[0])
+    self.owner[points[:, 0], points[:, 1]] = len(self.paths)
+    return len(self.paths)
+
+  def path(self, owner):
+    return self.paths[owner - 1]
+
+  def shape(self, owner):
+    return self.shapes[owner - 1]
+
+def get_optional_seeds(seeds, mid, a= 2, b=3):
+  optional_seeds = []
+  maxes = [0,0]
+  mins = [10000, 10000]
+  for i in seeds:
+    maxes[0] = max(i[0], maxes[0])
+    maxes[1] = max(i[1], maxes[1])
+    mins[0] = min(i[0], mins[0])
+    mins[1] = min(i[1], mins[1])
+    
+  optional_seeds.append( (int(mid[0] + a*mins[0])//b, int(mid[1]) ))
+  optional_seeds.append( ( int(mid[0]), int(mid[1] + a*mins[1])//b) )
+  optional_seeds.append( (int(mid[0] + a*maxes[0])//b  ,int(mid[1])) )
+  optional_seeds.append( (int(mid[0]), int(mid[1] + a*mins[1])//b) )
+
+  return optional_seeds
+  
+  
+def next_seeds(best_path, mean, count):
+  """Return the point and optional seeds to continue from on the next slice,
+  given the path and the running centroid (mean, count) of the filled region."""
+  recs_mean = (float(mean[0])/count, float(mean[1])/count)
+  optional_seeds = get_optional_seeds(best_path, recs_mean)
+  return (optional_seeds[0], optional_seeds)
+
+def trace_slice(ijk, hi, lo, bgArray, optional_seeds=[], cache=None, sliceKey=(), tracer='dfs',
+                tolerance=SMOOTH_TOLERANCE, timer=None):
+  """Trace the best path around ijk, sweeping lo down in SWEEP_STEP steps.
+  The masks of every level come from one quantized pass over the plane. Levels are
+  traced until a path has at most SWEEP_MAX_DEAD_ENDS dead ends, or SWEEP_LEVELS or
+  SWEEP_SECONDS run out, and the best scoring candidate is kept.
+  cache is an optional SliceCache and sliceKey the key of the plane bgArray belongs to.
+  tracer is one of TRACERS.
+  tolerance is the smoothing tolerance, see smooth_path, and timer an optional StageTimer.
+  Returns (best_path, visited, dead_ends, lo) with the threshold that was used.
+  """
+  with timed(timer, 'edges'):
+    levels = cached(cache, sliceKey + ('levels', hi, lo, SWEEP_STEP, SWEEP_LEVELS),
+                    get_sweep_levels, bgArray, hi, lo, SWEEP_STEP, SWEEP_LEVELS)
+  start = time.time()
+  best = None
+  for level in range(SWEEP_LEVELS):
+    level_lo = lo - level * SWEEP_STEP
+    with timed(timer, 'edges'):
+      masks = cached(cache, sliceKey + ('masks', hi, level_lo), sweep_masks, levels, level)
+    path = gimme_a_path(ijk, 200, hi, level_lo, bgArray, optional_seeds, masks,
+                        cache=cache, sliceKey=sliceKey, tracer=tracer, tolerance=tolerance, timer=timer)
+    score = sweep_score(path)
+    if best is None or score < best[0]:
+      best = (score, path, level_lo)
+    if 0 <= path[2] <= SWEEP_MAX_DEAD_ENDS or time.time() - start > SWEEP_SECONDS:
+      break
+  score, (best_path, visited, dead_ends), lo = best
+  return (best_path, visited, dead_ends, lo)
+
+def get_sweep_levels(bgArray, hi, lo, step, count):
+  """Quantize bgArray into sweep levels in one pass.
+  Returns (levels, neighbors): levels holds the first level whose lower threshold
+  (lo - level * step) lets the pixel in, or count if none does, and neighbors the
+  highest level of its 4 neighbors, with pixels outside the array counting as count.
+  """
+  levels = numpy.ceil((lo - bgArray.astype(float)) / step)
+  levels = numpy.clip(levels, 0, count).astype(numpy.int16)
+  levels[bgArray > hi] = count
+  padded = numpy.full((bgArray.shape[0] + 2, bgArray.shape[1] + 2), count, dtype=numpy.int16)
+  padded[1:-1, 1:-1] = levels
+  neighbors = numpy.maximum(numpy.maximum(padded[:-2, 1:-1], padded[2:, 1:-1]),
+                            numpy.maximum(padded[1:-1, :-2], padded[1:-1, 2:]))
+  return (levels, neighbors)
+
+def sweep_masks(sweep_levels, level):
+  """Return the (in_threshold, edges) masks of one level, as get_masks would."""
+  levels, neighbors = sweep_levels
+  in_threshold = levels <= level
+  return (in_threshold, in_threshold & (neighbors > level))
+
+def sweep_score(path):
+  """Return a sort key for a (points, visited, dead_ends) path, lowest is best.
+  Paths that were found beat those that were not, then fewer dead ends win,
+  then the larger enclosed area.
+  """
+  if path[2] < 0 or not path[0]:
+    return (1, 0, 0)
+  return (0, path[2], -path_shape(path[0])[1])
+
+def fill_plane(point, optional_seeds, hi, lo, bgArray, labelArray, label, maxPixels, out, paintOver=1, tracer='dfs',
+               tolerance=SMOOTH_TOLERANCE, prior=None):
+  """Trace and fill one plane without writing to labelArray.
+  The outline and the filled pixels are set to 1 in the uint8 array out.
+  prior is the best path of the plane before, to follow with track_plane if given.
+  Returns (best_path, mean, count), or None if no path was found or the fill was rejected.
+  """
+  out[...] = 0
+  result = None
+  if prior is not None:
+    result = track_plane(bgArray, labelArray, prior, point, hi, lo, maxPixels, label, paintOver, tracer, tolerance)
+  if result is None:
+    result, error = segment_plane(bgArray, labelArray, point, hi, lo, maxPixels, label, optional_seeds, paintOver,
+                                  tracer, tolerance)
+    if error is not None:
+      return None
+  mask, window, best_path, mean, count, lo = result
+  out[window][mask] = 1
+  return (best_path, mean, count)
+
+def gimme_a_path(location, seed_distance, hi, lo, bgArray, optional_seeds=[], masks=None, cache=None, sliceKey=(),
+                 tracer='dfs', tolerance=SMOOTH_TOLERANCE, timer=None, near=None):
+  """Finds the seeds, then builds the paths, then outputs the best path. No messy stuff required.
+  masks is the (in_threshold, edges) pair from get_masks; it is computed here if not given.
+  cache is an optional SliceCache and sliceKey the key of the plane bgArray belongs to.
+  tracer is 'moore' to trace contours with moore_path instead of build_path.
+  tolerance is the smoothing tolerance, see smooth_path, and near its get_near_mask mask,
+  computed here if not given.
+  timer is an optional StageTimer, every seed traced here counts as one call of 'trace'.
+  """
+  trace = moore_path if tracer == 'moore' else build_path
+  bestKey = sliceKey + ('best', tracer, hi, lo, tolerance, tuple(location), tuple(optional_seeds))
+  best_path = cached(cache, bestKey)
+  if best_path is not None:
+    return best_path
+  #
+  # Find edge pixels
+  #
+  with timed(timer, 'edges'):
+    if masks is None:
+      masks = cached(cache, sliceKey + ('masks', hi, lo), get_masks, bgArray, hi, lo)
+    in_threshold, edges = masks
+    seeds = cached(cache, sliceKey + ('seeds', hi, lo, tuple(location), seed_distance),
+                   find_edges, location, seed_distance, masks)
+  seeds = seeds + list(optional_seeds)
+  #
+  # Build paths
+  #
+  # Seeds on a contour traced before, by this call or an earlier one, reuse that contour
+  indexKey = sliceKey + ('index', tracer, hi, lo)
+  index = cached(cache, indexKey, PathIndex, edges.shape)
+  owners = []
+  for seed in seeds:
+    if seed is None or not in_bounds(edges, seed):
+      continue
+    owner = index.owner[seed]
+    if owner == 0:
+      with timed(timer, 'trace'):
+        owner = index.add(seed, trace(seed, edges))
+    if owner > 0 and owner not in owners:
+      owners.append(owner)
+  if cache is not None:
+    # Update the size estimate of the grown index
+    cache.put(indexKey, index)
+  paths = [index.path(owner) for owner in owners]
+  shapes = [index.shape(owner) for owner in owners]
+    
+  #
+  # Find best path
+  #
+  with timed(timer, 'best path'):
+    best_path = find_best_path(paths, location, shapes)
+  with timed(timer, 'smooth'):
+    if near is None:
+      near = cached(cache, sliceKey + ('near', hi, lo, tolerance), get_near_mask, bgArray, hi, lo, tolerance,
+                    in_threshold)
+    best_path = smooth_path(best_path, near)
+  if cache is not None:
+    cache.put(bestKey, best_path)
+        
+  return best_path
+    
+
+def smooth_path(path_obj, near):
+  """Smooth the path by adding the 8-neighbors of its pixels that are set in near to visited.
+  near is the get_near_mask mask of the plane. visited is returned as an (N, 2) coordinate array.
+  """
+  best_path, visited, dead_ends = path_obj
+  if not len(best_path):
+    return path_obj
+  mask, coordinates = smooth_mask(best_path, visited, near)
+  return (best_path, coordinates, dead_ends)
+
+def smooth_mask(best_path, visited, near):
+  """Return (mask, coordinates) of the visited pixels plus the 8-neighbors of the best_path
+  pixels that are set in near, computed with whole array operations on their bounding box.
+  """
+  points = numpy.asarray(best_path)
+  visited = numpy.asarray(visited)
+  top = max(int(visited[:, 0].min()) - 1, 0)
+  left = max(int(visited[:, 1].min()) - 1, 0)
+  bottom = min(int(visited[:, 0].max()) + 2, near.shape[0])
+  right = min(int(visited[:, 1].max()) + 2, near.shape[1])
+  height, width = bottom - top, right - left
+  # Dilate the path by one pixel in all 8 directions
+  padded = numpy.zeros((height + 2, width + 2), dtype=bool)
+  padded[points[:, 0] - top + 1, points[:, 1] - left + 1] = True
+  dilated = padded[1:-1, 1:-1].copy()
+  for offset in NEIGHBOR_OFFSETS:
+    dilated |= padded[1 + offset[0]:1 + offset[0] + height, 1 + offset[1]:1 + offset[1] + width]
+  box = dilated & near[top:bottom, left:right]
+  box[visited[:, 0] - top, visited[:, 1] - left] = True
+  mask = numpy.zeros(near.shape, dtype=bool)
+  mask[top:bottom, left:right] = box
+  coordinates = numpy.argwhere(box) + (top, left)
+  return (mask, coordinates)
+    
+  
+  ###
+  ###
+  ## End HERE ##########
+  ##
+  ###
+  ###
+
+def find_edge(point, offset, max_dist, edges):
+  """Return the first edgepoint and its distance from point using offset.
+  None if no path found.
+  """
+  if not in_bounds(edges, point):
+    return None
+  # Only walk the part of the ray that stays inside the plane
+  steps = max_dist - 1
+  for axis in (0, 1):
+    if offset[axis] > 0:
+      steps = min(steps, edges.shape[axis] - 1 - point[axis])
+    elif offset[axis] < 0:
+      steps = min(steps, point[axis])
+  if steps <= 0:
+    return None
+  distances = numpy.arange(1, steps + 1)
+  ray = edges[point[0] + offset[0] * distances, point[1] + offset[1] * distances]
+  hits = numpy.flatnonzero(ray)
+  if hits.size == 0:
+    return None
+  i = int(hits[0]) + 1
+  return ((point[0] + i * offset[0], point[1] + i * offset[1]), i)
+
+def find_edges(starting_point, max_dist, masks):
+  """Return an array of edge points found growing outward from starting_point.
+  Search does not exceed max_dist.
+  If starting_point is within threshold, find a maximum of 4 points, one for each offset.
+  If starting_point is NOT within threshold, try to find as many as 8 points; two for each offset.
+  """
+  in_threshold, edges = masks
+  if not in_bounds(in_threshold, starting_point):
+    return None
+  inside = in_threshold[starting_point]
+  offsets = [(0,1), (1,0), (0,-1), (-1,0)]
+  edgePoints = []
+  for offset in offsets:
+    first_result = find_edge(starting_point, offset, max_dist, edges)
+    if first_result is not None:
+      edgePoints.append(first_result[0])
+      if not inside:
+        # Try to find second point, since starting click was outside threshold
+        second_result = find_edge(first_result[0], offset, max_dist - first_result[1], edges)
+        if second_result is not None:
+          edgePoints.append(second_result[0])
+  return edgePoints
+
+def build_path(start, edges):
+  """Return a complete path from start."""
+  dead_ends = 0
+  offsets = NEIGHBOR_OFFSETS
+  visited = [start,]
+  # Mirror of visited for constant time membership checks
+  visited_set = set(visited)
+  path = [start,]
+  location = start
+  while path != []:
+    found = False
+    for offset in offsets:
+      neighbor = (location[0] + offset[0], location[1] + offset[1])
+      if len(visited) > 1 and neighbor == start:
+        return (path, visited, dead_ends)
+      if is_edge(neighbor, edges) and neighbor not in visited_set:
+        visited.append(neighbor)
+        visited_set.add(neighbor)
+        path.append(neighbor)
+        location = neighbor
+        found = True
+        break
+    if not found:
+      # Dead end found, re-trace steps
+      dead_ends += 1
+      path.pop()
+      if len(path) > 0:
+        location = path[len(path)-1]
+  # Backtracked all the way, start is not on a closed path
+  return ([],[], -1)
+
+def moore_path(start, edges):
+  """Trace the boundary of the edge pixels connected to start by Moore-neighbour tracing.
+  Each step scans the neighbors clockwise from the last non-edge pixel, so the walk is
+  linear in the length of the boundary. The walk stops when it leaves start by the same
+  move as it first did (Jacob's stopping criterion). Returns (path, visited, revisits)
+  like build_path: path is the closed walk, visited its pixels once each and revisits
+  counts steps onto pixels already walked (spurs and pinches), standing in for dead ends.
+  Returns ([], [], -1) if no closed boundary goes through start.
+  """
+  offsets = NEIGHBOR_OFFSETS
+  if not is_edge(start, edges):
+    return ([],[], -1)
+  rows, columns = edges.shape
+  # Enter start from a non-edge 4-neighbor, every edge pixel has one
+  backtrack = None
+  for d in (0, 2, 4, 6):
+    if not is_edge((start[0] + offsets[d][0], start[1] + offsets[d][1]), edges):
+      backtrack = d
+      break
+  if backtrack is None:
+    return ([],[], -1)
+  path = []
+  visited = []
+  visited_set = set()
+  moves = set()
+  first_move = None
+  revisits = 0
+  location = start
+  while True:
+    for turn in range(1, 9):
+      d = (backtrack + turn) % 8
+      row, column = location[0] + offsets[d][0], location[1] + offsets[d][1]
+      if 0 <= row < rows and 0 <= column < columns and edges[row, column]:
+        break
+    else:
+      # Isolated pixel
+      return ([],[], -1)
+    if first_move is None:
+      first_move = d
+    elif location == start and d == first_move:
+      return (path, visited, revisits)
+    if (location, d) in moves:
+      # Caught in a loop that does not go through start
+      return ([],[], -1)
+    moves.add((location, d))
+    path.append(location)
+    if location in visited_set:
+      revisits += 1
+    else:
+      visited.append(location)
+      visited_set.add(location)
+    # The pixel scanned just before the neighbor is not an edge, it is the next backtrack
+    backtrack = MOORE_BACKTRACK[d]
+    location = (row, column)
+
+def find_best_path(paths, ijk, shapes=None):
+  """Returns the path enclosing ijk with the largest area from a list of paths ([points], [visited], dead_ends).
+  shapes optionally holds the path_shape of each path, so it is not computed again.
+  """
+  best_path = ([],[],-1)
+  best_area = 0
+  for n, path in enumerate(paths):
+    shape = shapes[n] if shapes is not None else path_shape(path[0])
+    # Only test containment for paths that would win
+    if shape[1] > best_area and polygon_contains(shape, ijk):
+      best_path = path
+      best_area = shape[1]
+  return best_path
+
+def path_shape(points):
+  """Return (extrema, area, polygon) of a contour given by its ordered points:
+  its bounding box as get_extrema returns it, its shoelace area and its points
+  as an (N, 2) float array.
+  """
+  polygon = numpy.asarray(points, dtype=float).reshape(-1, 2)
+  if not len(polygon):
+    return ((0, 0, 0, 0), 0.0, polygon)
+  x, y = polygon[:, 0], polygon[:, 1]
+  area = 0.5 * abs(numpy.dot(x, numpy.roll(y, -1)) - numpy.dot(y, numpy.roll(x, -1)))
+  extrema = (int(x.min()), int(x.max()), int(y.min()), int(y.max()))
+  return (extrema, area, polygon)
+
+def path_closed(points):
+  """Return true if the path ends next to where it starts, so that it can enclose a region."""
+  if not len(points):
+    return False
+  first, last = points[0], points[-1]
+  return abs(first[0] - last[0]) <= 1 and abs(first[1] - last[1]) <= 1
+
+def polygon_contains(shape, point):
+  """Return true if point is inside the path_shape contour shape (even-odd rule), or one of its points."""
+  extrema, area, polygon = shape
+  px, py = point[0], point[1]
+  if not (extrema[0] <= px <= extrema[1] and extrema[2] <= py <= extrema[3]):
+    return False
+  x, y = polygon[:, 0], polygon[:, 1]
+  if numpy.any((x == px) & (y == py)):
+    return True
+  next_x, next_y = numpy.roll(x, -1), numpy.roll(y, -1)
+  crosses = (y > py) != (next_y > py)
+  with numpy.errstate(divide='ignore', invalid='ignore'):
+    cross_x = x + (py - y) * (next_x - x) / (next_y - y)
+  return bool(numpy.count_nonzero(crosses & (px < cross_x)) % 2)
+        
+
+def fill_path(fill_point, best_path, labelArray, label, maxPixels, paintOver=1, outline=None):
+  """Fill the inside of best_path from fill_point without writing to labelArray.
+  outline optionally masks pixels that are going to be labelled but are not yet.
+  Returns (region, pixelsSet, leaked) as scanline_fill does.
+  """
+  extrema = get_extrema(best_path)
+  barrier = path_mask(best_path, labelArray.shape)
+  # only count those pixels that are changed, so clicking again inside a filled region
+  # is measured against maxPixels by what it adds
+  changed = labelArray != label
+  if outline is not None:
+    changed &= ~outline
+  if not paintOver:
+    # label filled already and not painting over, leave it alone
+    barrier |= labelArray != 0
+    if outline is not None:
+      barrier |= outline
+  return scanline_fill(fill_point, barrier, extrema, maxPixels, changed)
+
+def path_mask(pixels, shape):
+  """Return a boolean mask of the given shape with the listed pixel coordinates set."""
+  mask = numpy.zeros(shape, dtype=bool)
+  if len(pixels):
+    pixels = numpy.asarray(pixels)
+    mask[pixels[:, 0], pixels[:, 1]] = True
+  return mask
+
+def region_centroid(region):
+  """Return the running centroid (mean, count) of a filled region, where mean is the coordinate sum."""
+  region_xs, region_ys = numpy.nonzero(region)
+  return ((int(region_xs.sum()), int(region_ys.sum())), len(region_xs))
+
+def scanline_fill(seed, barrier, extrema, maxPixels, changed):
+  """Flood fill the 4-connected pixels around seed that are not in barrier, one row span at a time.
+  Every filled pixel must lie strictly inside extrema (min_x, max_x, min_y, max_y); reaching
+  a pixel outside it means the fill leaked out of the path, and filling stops.
+  Filling also stops once more than maxPixels of the pixels marked in changed have been filled;
+  the region is then incomplete and pixelsSet over maxPixels, so the fill is to be rejected.
+  Returns (region, pixelsSet, leaked) where region is a boolean mask of the filled pixels.
+  """
+  region = numpy.zeros(barrier.shape, dtype=bool)
+  if not in_bounds(barrier, seed) or barrier[seed]:
+    return (region, 0, False)
+  rows, cols = barrier.shape
+  pixelsSet = 0
+  toVisit = [seed]
+  while toVisit != []:
+    x, y = toVisit.pop()
+    if region[x, y]:
+      continue
+    # Grow the span left and right until a barrier pixel or the edge of the array
+    blocked = numpy.flatnonzero(barrier[x, :y])
+    left = blocked[-1] + 1 if blocked.size else 0
+    blocked = numpy.flatnonzero(barrier[x, y + 1:])
+    right = y + blocked[0] if blocked.size else cols - 1
+    if not (extrema[0] < x < extrema[1] and extrema[2] < left and right < extrema[3]):
+      return (region, pixelsSet, True)
+    region[x, left:right + 1] = True
+    pixelsSet += int(numpy.count_nonzero(changed[x, left:right + 1]))
+    if pixelsSet > maxPixels:
+      return (region, pixelsSet, False)
+    # Queue one seed for every open run of pixels above and below the span
+    for next_x in (x - 1, x + 1):
+      if not 0 <= next_x < rows:
+        continue
+      open_pixels = ~(barrier[next_x, left:right + 1] | region[next_x, left:right + 1])
+      starts = numpy.flatnonzero(open_pixels & ~numpy.concatenate(([False], open_pixels[:-1])))
+      for start in starts:
+        toVisit.append((next_x, left + int(start)))
+  return (region, pixelsSet, False)
+
+def get_extrema(list):
+  """Returns the max and min x and y values from a list of coordinate tuples in the form of (min_x, max_x, min_y, max_y)."""
+  max_x = max(list,key=lambda item:item[0])[0]
+  max_y = max(list,key=lambda item:item[1])[1]
+  min_x = min(list,key=lambda item:item[0])[0]
+  min_y = min(list,key=lambda item:item[1])[1]
+  return (min_x, max_x, min_y, max_y)
+
+def get_near_mask(bgArray, hi, lo, tolerance, in_threshold):
+  """Return the mask of pixels outside the threshold by at most tolerance."""
+  return ~in_threshold & (bgArray >= lo - tolerance) & (bgArray <= hi + tolerance)
+
+def get_masks(bgArray, hi, lo):
+  """Return the (in_threshold, edges) boolean masks of bgArray in one pass.
+  A pixel is an edge if it is within threshold and at least one of its 4 neighbors
+  is outside the threshold or outside the array.
+  """
+  in_threshold = (bgArray >= lo) & (bgArray <= hi)
+  padded = numpy.zeros((bgArray.shape[0] + 2, bgArray.shape[1] + 2), dtype=bool)
+  padded[1:-1, 1:-1] = in_threshold
+  surrounded = padded[:-2, 1:-1] & padded[2:, 1:-1] & padded[1:-1, :-2] & padded[1:-1, 2:]
+  edges = in_threshold & ~surrounded
+  return (in_threshold, edges)
+
+def band_masks(bgArray, prior, hi, lo, tolerance, band):
+  """Return (window, masks, near) for following the contour prior on bgArray.
+  window is the index tuple of the box around prior grown by band + 1, clipped to bgArray.
+  masks is the (in_threshold, edges) pair of get_masks and near the get_near_mask mask,
+  on that window, restricted to the pixels within band of prior (band + 1 for in_threshold
+  and near, so that the edges in the band are exactly those of get_masks).
+  """
+  points = numpy.asarray(prior)
+  top = max(int(points[:, 0].min()) - band - 1, 0)
+  left = max(int(points[:, 1].min()) - band - 1, 0)
+  bottom = min(int(points[:, 0].max()) + band + 2, bgArray.shape[0])
+  right = min(int(points[:, 1].max()) + band + 2, bgArray.shape[1])
+  window = bgArray[top:bottom, left:right]
+  inner = numpy.zeros(window.shape, dtype=bool)
+  inner[points[:, 0] - top, points[:, 1] - left] = True
+  inner = dilate(inner, band)
+  outer = dilate(inner, 1)
+  in_threshold = (window >= lo) & (window <= hi) & outer
+  near = ~in_threshold & (window >= lo - tolerance) & (window <= hi + tolerance) & outer
+  # Pixels outside the window count as outside the threshold, like those outside the plane
+  padded = numpy.zeros((window.shape[0] + 2, window.shape[1] + 2), dtype=bool)
+  padded[1:-1, 1:-1] = in_threshold
+  surrounded = padded[:-2, 1:-1] & padded[2:, 1:-1] & padded[1:-1, :-2] & padded[1:-1, 2:]
+  edges = in_threshold & ~surrounded & inner
+  return ((slice(top, bottom), slice(left, right)), (in_threshold, edges), near)
+
+def dilate(mask, radius):
+  """Return mask grown by radius pixels in chessboard distance, with one pass per axis."""
+  grown = mask.copy()
+  for step in range(1, radius + 1):
+    grown[step:, :] |= mask[:-step, :]
+    grown[:-step, :] |= mask[step:, :]
+  rows = grown.copy()
+  for step in range(1, radius + 1):
+    grown[:, step:] |= rows[:, :-step]
+    grown[:, :-step] |= rows[:, step:]
+  return grown
+
+def is_edge(location, edges):
+  """Return true is location is an edge pixel."""
+  return in_bounds(edges, location) and bool(edges[location])
+
+def in_bounds(array, coordinate):
+  """Return true if coordinate is a valid index into the 2D array."""
+  return 0 <= coordinate[0] < array.shape[0] and 0 <= coordinate[1] < array.shape[1]